@@ -0,0 +1,229 @@
+#!/bin/env python
+#
+# This script times the stages of program_10.py (ReadData, ClipData, the
+# annual and monthly statistics and averages, and the individual Calc*
+# metric functions) and records their peak memory use.  It runs on the two
+# gauge files of the assignment and on synthetic USGS RDB records of any
+# number of years and stations, and writes the results as JSON so that
+# throughput and memory can be compared between versions.
+#
+#   python benchmark.py --years 10 50 --stations 1 10 --output bench.json
+#
+#
+import argparse
+import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import scipy
+import numpy as np
+
+import program_10 as p10
+
+# gauge files provided with the assignment
+GaugeFiles = { "Wildcat": "WildcatCreek_Discharge_03335000_19540601-20200315.txt",
+               "Tippe": "TippecanoeRiver_Discharge_03331500_19431001-20200315.txt" }
+
+# header written at the top of synthetic files, as in NWIS output
+Header = """# ---------------------------------- WARNING ----------------------------------------
+# Synthetic record written by benchmark.py for timing program_10.py.
+#
+# Data-value qualification codes included in this output:
+#     A  Approved for publication -- Processing and review completed.
+#     P  Provisional data subject to revision.
+#     e  Value has been estimated.
+#
+agency_cd\tsite_no\tdatetime\t{0}_00060_00003\t{0}_00060_00003_cd
+5s\t15s\t20d\t14n\t10s
+"""
+
+def MakeSyntheticRecord( fileName, years, site_no=3300000, seed=0,
+                         startDate='1700-10-01', gapFraction=0.01,
+                         eqpFraction=0.001, absentFraction=0.005 ):
+    """This function writes a synthetic daily discharge record of the given
+    number of years to fileName in USGS RDB format.  Flows follow a seasonal
+    cycle with autocorrelated log-normal noise.  A fraction gapFraction of
+    the days have an empty value in runs of up to 60 days, eqpFraction are
+    flagged "Eqp", and absentFraction of the dates are left out of the file
+    entirely.  Values are mostly approved ("A"), some estimated ("A:e"), and
+    the last 60 days are provisional ("P").  Dates must fit the nanosecond
+    timestamps of pandas (1677 to 2262), so the default start allows
+    records of up to 560 years.  The routine returns the number of rows
+    written."""
+
+    rng = np.random.default_rng(seed)
+    nDays = int(round(years*365.25))
+    if nDays > (pd.Timestamp.max.date() - pd.Timestamp(startDate).date()).days + 1:
+        raise ValueError("{} years from {} end after the last pandas timestamp, {}"
+                         .format(years, startDate, pd.Timestamp.max.date()))
+    dates = pd.date_range(startDate, periods=nDays, freq='D')
+    n = len(dates)
+
+    # seasonal log flow with AR(1) noise, as a truncated moving average
+    noise = rng.normal(0, 0.35, n)
+    shocks = np.convolve(noise, 0.95**np.arange(200))[:n]
+    logQ = 6 + 0.8*np.sin(2*np.pi*(dates.dayofyear.values - 30)/365.25) + 0.3*shocks
+    Q = np.round(np.exp(logQ), 1)
+
+    # quality codes
+    Quality = np.where(rng.random(n) < 0.05, 'A:e', 'A').astype(object)
+    Quality[-60:] = 'P'
+
+    # discharge text with gaps in runs and Eqp flags
+    Discharge = np.char.mod('%g', Q).astype(object)
+    starts = np.flatnonzero(rng.random(n) < gapFraction/30)
+    for s in starts:
+        end = s + rng.integers(1, 61)
+        Discharge[s:end] = ''
+        Quality[s:end] = ''
+    eqp = rng.random(n) < eqpFraction
+    Discharge[eqp] = 'Eqp'
+
+    # leave some dates out of the file
+    keep = rng.random(n) >= absentFraction
+    DataDF = pd.DataFrame({'agency_cd': 'USGS', 'site_no': '{:08d}'.format(site_no),
+                           'Date': dates.strftime('%Y-%m-%d'),
+                           'Discharge': Discharge, 'Quality': Quality})[keep]
+
+    with open(fileName, 'w') as f:
+        f.write(Header.format(seed % 100000))
+        DataDF.to_csv(f, sep='\t', header=False, index=False)
+
+    return( len(DataDF) )
+
+def BenchStage( func, args, repeat=3, memory=True ):
+    """This function times func(*args), returning the best wall time of
+    repeat calls in seconds and, if memory is True, the peak memory
+    allocated during one further call traced with tracemalloc (None
+    otherwise).  The result of the last call is returned as well."""
+
+    seconds = np.inf
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        result = func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return( seconds, peak, result )
+
+def BenchRecords( fileNames, repeat=3, memory=True ):
+    """This function benchmarks every stage of program_10.py on the given
+    station files, summing times (and taking the largest peak memory) over
+    stations.  ClipData clips off the first and last water year of each
+    record.  The Calc* functions are timed applied to every water year of
+    the clipped record, as GetAnnualStatistics used to apply them.  The
+    routine returns a dictionary of results keyed by stage name."""
+
+    Stages = {}
+
+    def Record( stage, seconds, peak, rows ):
+        result = Stages.setdefault(stage, {'seconds': 0.0, 'peak_bytes': None, 'rows': 0})
+        result['seconds'] += seconds
+        result['rows'] += int(rows)
+        if peak is not None:
+            result['peak_bytes'] = max(result['peak_bytes'] or 0, peak)
+
+    for fileName in fileNames:
+
+        seconds, peak, (DataDF, MissingValues) = BenchStage(p10.ReadData, (fileName,), repeat, memory)
+        Record('ReadData', seconds, peak, len(DataDF))
+
+        first = pd.Timestamp(DataDF.index.min().year + 1, 10, 1)
+        last = pd.Timestamp(DataDF.index.max().year - 1, 9, 30)
+        # the stages leave their input unchanged, so one copy, made outside
+        # the timed calls, keeps the ReadData result intact
+        DataDF = DataDF.copy()
+        seconds, peak, (DataDF, MissingValues) = BenchStage(p10.ClipData, (DataDF, first, last), repeat, memory)
+        Record('ClipData', seconds, peak, len(DataDF))
+
+        seconds, peak, WYDataDF = BenchStage(p10.GetAnnualStatistics, (DataDF,), repeat, memory)
+        Record('GetAnnualStatistics', seconds, peak, len(DataDF))
+
+        seconds, peak, MoDataDF = BenchStage(p10.GetMonthlyStatistics, (DataDF,), repeat, memory)
+        Record('GetMonthlyStatistics', seconds, peak, len(DataDF))
+
+        seconds, peak, result = BenchStage(p10.GetAnnualAverages, (WYDataDF,), repeat, memory)
+        Record('GetAnnualAverages', seconds, peak, len(WYDataDF))
+
+        seconds, peak, result = BenchStage(p10.GetMonthlyAverages, (MoDataDF,), repeat, memory)
+        Record('GetMonthlyAverages', seconds, peak, len(MoDataDF))
+
+        # metric functions applied to each water year
+        year = DataDF.index.year.values + (DataDF.index.month.values >= 10)
+        Groups = DataDF['Discharge'].groupby(year)
+        for func in [p10.CalcTqmean, p10.CalcRBindex, p10.Calc7Q, p10.CalcExceed3TimesMedian]:
+            seconds, peak, result = BenchStage(lambda: Groups.apply(func), (), repeat, memory)
+            Record(func.__name__, seconds, peak, len(DataDF))
+
+    for result in Stages.values():
+        result['rows_per_second'] = result['rows']/result['seconds'] if result['seconds'] > 0 else None
+
+    return( Stages )
+
+def RunBenchmarks( years=(10, 50), stations=(1, 10), repeat=3, memory=True,
+                   gauges=True, workDir=None ):
+    """This function runs BenchRecords on the assignment gauge files (if
+    gauges is True) and on synthetic records for every combination of
+    record length in years and number of stations, written to workDir (a
+    temporary directory by default).  The routine returns the report as a
+    dictionary ready to be written as JSON."""
+
+    Report = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'platform': platform.platform(),
+              'versions': {'python': platform.python_version(), 'numpy': np.__version__,
+                           'pandas': pd.__version__, 'scipy': scipy.__version__},
+              'repeat': repeat,
+              'cases': []}
+
+    if gauges:
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name, fileName in GaugeFiles.items():
+            Report['cases'].append({'case': name, 'years': None, 'stations': 1,
+                                    'stages': BenchRecords([os.path.join(here, fileName)], repeat, memory)})
+
+    with tempfile.TemporaryDirectory(dir=workDir) as tmp:
+        for nYears in years:
+            for nStations in stations:
+                fileNames = []
+                for i in range(nStations):
+                    fileName = os.path.join(tmp, 'Synthetic{}_Discharge_{}y.txt'.format(i, nYears))
+                    if not os.path.exists(fileName):
+                        MakeSyntheticRecord(fileName, nYears, site_no=3300000 + i, seed=i)
+                    fileNames.append(fileName)
+                Report['cases'].append({'case': 'synthetic', 'years': nYears, 'stations': nStations,
+                                        'stages': BenchRecords(fileNames, repeat, memory)})
+
+    return( Report )
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the stages of program_10.py.')
+    parser.add_argument('--years', type=int, nargs='+', default=[10, 50, 100], help='synthetic record lengths in years')
+    parser.add_argument('--stations', type=int, nargs='+', default=[1, 10], help='synthetic station counts')
+    parser.add_argument('--repeat', type=int, default=3, help='timed calls per stage, the best is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc peak memory runs')
+    parser.add_argument('--no-gauges', action='store_true', help='skip the assignment gauge files')
+    parser.add_argument('--workdir', default=None, help='directory for the synthetic files')
+    parser.add_argument('--output', default='benchmark.json', help='JSON report file')
+    args = parser.parse_args()
+
+    Report = RunBenchmarks(args.years, args.stations, args.repeat, not args.no_memory,
+                           not args.no_gauges, args.workdir)
+    with open(args.output, 'w') as f:
+        json.dump(Report, f, indent=2)
+
+    # short summary of the cases
+    for case in Report['cases']:
+        print("-"*50, "\n{} years={} stations={}".format(case['case'], case['years'], case['stations']))
+        for stage, result in case['stages'].items():
+            print("  {:24s} {:10.4f} s  {:>12} peak bytes".format(stage, result['seconds'], str(result['peak_bytes'])))
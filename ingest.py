@@ -0,0 +1,278 @@
+#!/bin/env python
+#
+# This module fetches USGS NWIS daily discharge files in RDB format for many
+# sites concurrently with asyncio and parses each response in memory with
+# ReadData from program_10.py, so no temporary files are written.  HTTP
+# connections are pooled and reused, the number of requests in flight is
+# bounded, each request has a timeout, and failed requests are retried with
+# exponential backoff.
+#
+# A small local HTTP server that serves the assignment gauge files in place
+# of NWIS is included, so the module can be run and tested offline:
+#
+#   python ingest.py
+#
+#
+import asyncio
+import http.server
+import io
+import os
+import ssl
+import threading
+import time
+import urllib.parse
+
+import program_10 as p10
+
+# NWIS daily values service and the gauge files served by the local stub
+NwisBase = 'https://waterservices.usgs.gov/nwis/dv/'
+GaugeFiles = { "03335000": "WildcatCreek_Discharge_03335000_19540601-20200315.txt",
+               "03331500": "TippecanoeRiver_Discharge_03331500_19431001-20200315.txt" }
+
+class HTTPError(Exception):
+    """Raised for a response with an error status.  retry is True for
+    statuses worth retrying (429 and 5xx)."""
+
+    def __init__(self, status, url):
+        super().__init__('HTTP {} for {}'.format(status, url))
+        self.status = status
+        self.retry = status == 429 or status >= 500
+
+def NwisUrl( site, startDate=None, endDate=None, base=NwisBase ):
+    """This function returns the URL of the daily mean discharge of a site
+    in RDB format from the NWIS daily values service (or a server with the
+    same interface at base)."""
+
+    query = {'format': 'rdb', 'sites': site, 'parameterCd': '00060', 'statCd': '00003'}
+    if startDate is not None:
+        query['startDT'] = startDate
+    if endDate is not None:
+        query['endDT'] = endDate
+
+    return( base + '?' + urllib.parse.urlencode(query) )
+
+class ConnectionPool:
+    """This class keeps idle HTTP/1.1 keep-alive connections to each host so
+    they can be reused by later requests."""
+
+    def __init__(self):
+        self.idle = {}
+
+    async def Open(self, scheme, host, port):
+        """Returns an idle connection to the host, or opens a new one."""
+        while self.idle.get((scheme, host, port)):
+            reader, writer = self.idle[(scheme, host, port)].pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return( reader, writer )
+            writer.close()
+        context = ssl.create_default_context() if scheme == 'https' else None
+        return( await asyncio.open_connection(host, port, ssl=context) )
+
+    def Release(self, scheme, host, port, reader, writer, reusable):
+        """Returns a connection to the pool, or closes it."""
+        if reusable:
+            self.idle.setdefault((scheme, host, port), []).append((reader, writer))
+        else:
+            writer.close()
+
+    def Close(self):
+        """Closes all idle connections."""
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+async def Get( pool, url, blockSize=2**16 ):
+    """This function sends a GET request for url over a pooled connection
+    and reads the response body (plain, Content-Length or chunked) block by
+    block into a BytesIO buffer.  The routine returns the buffer positioned
+    at its start, or raises HTTPError for an error status."""
+
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    reader, writer = await pool.Open(parts.scheme, parts.hostname, port)
+    try:
+        writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nAccept-Encoding: identity\r\nConnection: keep-alive\r\n\r\n'
+                     .format(path, parts.netloc).encode('latin-1'))
+        await writer.drain()
+
+        # status line and headers
+        status = await reader.readline()
+        if not status:
+            raise ConnectionError('connection closed by {}'.format(parts.netloc))
+        status = int(status.split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        # body
+        body = io.BytesIO()
+        reusable = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()).strip():
+                        pass
+                    break
+                body.write(await reader.readexactly(size))
+                await reader.readexactly(2)
+        elif 'content-length' in headers:
+            remaining = int(headers['content-length'])
+            while remaining > 0:
+                block = await reader.read(min(blockSize, remaining))
+                if not block:
+                    raise ConnectionError('response from {} ended early'.format(parts.netloc))
+                body.write(block)
+                remaining -= len(block)
+        else:
+            reusable = False
+            while True:
+                block = await reader.read(blockSize)
+                if not block:
+                    break
+                body.write(block)
+    except BaseException:
+        writer.close()
+        raise
+
+    pool.Release(parts.scheme, parts.hostname, port, reader, writer, reusable)
+    if status >= 400:
+        raise HTTPError(status, url)
+    body.seek(0)
+
+    return( body )
+
+async def FetchSites( urls, concurrency=8, retries=3, backoff=0.5, timeout=60 ):
+    """This function fetches the RDB file of every site in urls (a dictionary
+    of names and URLs) with at most concurrency requests in flight, and
+    parses each response with ReadData in a worker thread.  A request that
+    takes longer than timeout seconds (connecting, or waiting for the
+    server) is abandoned.  Connection errors, timeouts and 429/5xx
+    responses are retried up to retries times, waiting backoff seconds and
+    doubling the wait each time.  The routine
+    returns a dictionary of (DataDF, MissingValues) tuples and a dictionary
+    of error messages for the sites that failed."""
+
+    pool = ConnectionPool()
+    limit = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+    Data = {}
+    Failures = {}
+
+    async def Fetch( name, url ):
+        wait = backoff
+        for attempt in range(retries + 1):
+            try:
+                async with limit:
+                    body = await asyncio.wait_for(Get(pool, url), timeout)
+                Data[name] = await loop.run_in_executor(None, p10.ReadData, body)
+                return
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, HTTPError) as error:
+                if attempt == retries or (isinstance(error, HTTPError) and not error.retry):
+                    Failures[name] = '{}: {}'.format(type(error).__name__, error)
+                    return
+            except Exception as error:
+                Failures[name] = '{}: {}'.format(type(error).__name__, error)
+                return
+            await asyncio.sleep(wait)
+            wait *= 2
+
+    try:
+        await asyncio.gather(*[Fetch(name, url) for name, url in urls.items()])
+    finally:
+        pool.Close()
+
+    return( Data, Failures )
+
+def IngestSites( urls, concurrency=8, retries=3, backoff=0.5, timeout=60 ):
+    """This function runs FetchSites from synchronous code."""
+
+    return( asyncio.run(FetchSites(urls, concurrency, retries, backoff, timeout)) )
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the files of the stub server as NWIS daily values RDB output
+    for GET requests of /nwis/dv/?sites=<site>, with keep-alive."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urllib.parse.urlsplit(self.path)
+        site = urllib.parse.parse_qs(parts.query).get('sites', [''])[0]
+        fileName = self.server.files.get(site)
+
+        # stall or fail the first requests of a site when asked to, to test
+        # timeouts and retries
+        if self.server.stalls.get(site, 0) > 0:
+            self.server.stalls[site] -= 1
+            time.sleep(self.server.stallTime)
+        if self.server.failures.get(site, 0) > 0:
+            self.server.failures[site] -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if parts.path.rstrip('/') != '/nwis/dv' or fileName is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(os.path.getsize(fileName)))
+        self.end_headers()
+        with open(fileName, 'rb') as f:
+            for block in iter(lambda: f.read(2**16), b''):
+                self.wfile.write(block)
+
+    def log_message(self, format, *args):
+        pass
+
+def StartStubServer( files=None, failures=None, stalls=None, stallTime=5.0,
+                     host='127.0.0.1', port=0 ):
+    """This function starts a local HTTP server in a background thread that
+    stands in for NWIS, serving files (a dictionary of site numbers and RDB
+    file paths, the assignment gauges by default) at /nwis/dv/?sites=<site>.
+    failures optionally gives a number of 503 responses to return for a
+    site before serving it, and stalls a number of requests of a site to
+    hold for stallTime seconds before answering.  The routine returns the
+    server, to be stopped with server.shutdown(), and its base URL for
+    NwisUrl."""
+
+    if files is None:
+        here = os.path.dirname(os.path.abspath(__file__))
+        files = {site: os.path.join(here, fileName) for site, fileName in GaugeFiles.items()}
+    server = http.server.ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.files = files
+    server.failures = dict(failures or {})
+    server.stalls = dict(stalls or {})
+    server.stallTime = stallTime
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return( server, 'http://{}:{}/nwis/dv/'.format(*server.server_address) )
+
+if __name__ == '__main__':
+
+    # fetch the two assignment gauges from the local stub, with one failed
+    # request for Wildcat to exercise the retry logic
+    server, base = StartStubServer(failures={"03335000": 1})
+    urls = { "Wildcat": NwisUrl("03335000", base=base),
+             "Tippe": NwisUrl("03331500", base=base),
+             "Missing": NwisUrl("00000000", base=base) }
+    Data, Failures = IngestSites(urls, concurrency=2, backoff=0.1)
+    server.shutdown()
+
+    for name, (DataDF, MissingValues) in Data.items():
+        print( "-"*50, "\n\nFetched data for {}...\n\n".format(name), DataDF.describe(), "\n\nMissing values: {}\n\n".format(MissingValues))
+    for name, error in Failures.items():
+        print( "-"*50, "\n\nFailed site {}: {}\n".format(name, error))
@@ -0,0 +1,112 @@
+#!/bin/env python
+#
+# This module computes n-day low flows (nQm, e.g. 1Q, 7Q, 30Q) for each
+# year of a daily streamflow record, and their return-period estimates
+# (xQy, e.g. 7Q10) from a log-Pearson type III fit, for use with the
+# DataFrames built by program_10.py.
+#
+#
+import pandas as pd
+import scipy.stats as stats
+import numpy as np
+
+def GetLowFlowSeries( DataDF, windows=(1, 3, 7, 30, 90), startMonth=10,
+                      completeness=0.9 ):
+    """This function computes the n-day low flow of every year of a daily
+    streamflow time series for each window length n in windows.  The n-day
+    low flow is the lowest n-day moving average of flow in the year.  All
+    window lengths are computed from one cumulative sum over the whole
+    record.  Missing days, either NaN values or dates absent from the index,
+    are not averaged across: only windows of n complete days that lie within
+    one year are used, and a year without any such window is NaN.  Years
+    with values on less than a fraction completeness of their calendar days,
+    such as the partial first and last years of a record, are NaN as well,
+    so they are left out of GetLowFlowFrequency (0 keeps every year).  Years
+    start on the first day of startMonth (October, the water year, by
+    default; use 4 for the climatic year often used for low flows).  The
+    routine returns a DataFrame with one row per year, indexed by the start
+    date of the year, and one column per window named like "7Q"."""
+
+    # put the record on a complete daily calendar of whole years so gaps,
+    # and the missing parts of the first and last years, are explicit
+    Discharge = DataDF['Discharge']
+    first = Discharge.index.min()
+    last = Discharge.index.max()
+    dates = pd.date_range(pd.Timestamp(first.year - (first.month < startMonth), startMonth, 1),
+                          pd.Timestamp(last.year + (last.month >= startMonth), startMonth, 1) - pd.Timedelta(1, 'D'),
+                          freq='D')
+    Q = Discharge.reindex(dates).values.astype(np.float64)
+
+    # year of each day, numbered by the calendar year in which it starts
+    year = dates.year.values - (dates.month.values < startMonth)
+    firstYear = year.min()
+    codes = year - firstYear
+    nYears = codes.max() + 1
+    start = np.searchsorted(codes, codes)
+
+    # cumulative sums of flow and of complete days
+    valid = ~np.isnan(Q)
+    cumQ = np.concatenate(([0.0], np.cumsum(np.where(valid, Q, 0.0))))
+    cumN = np.concatenate(([0], np.cumsum(valid)))
+    complete = np.bincount(codes, weights=valid, minlength=nYears) >= completeness*np.bincount(codes, minlength=nYears)
+
+    LowFlowDF = pd.DataFrame(index=pd.DatetimeIndex([pd.Timestamp(firstYear + i, startMonth, 1) for i in range(nYears)],
+                                                    name=DataDF.index.name))
+    for n in windows:
+
+        # n-day averages of the windows ending on each day
+        end = np.arange(n - 1, len(Q))
+        avg = (cumQ[n:] - cumQ[:-n])/n
+        ok = ((cumN[n:] - cumN[:-n]) == n) & (end - start[end] >= n - 1)
+
+        # lowest average in each year
+        low = np.full(nYears, np.inf)
+        np.minimum.at(low, codes[end[ok]], avg[ok])
+        low[np.isinf(low) | ~complete] = np.nan
+        LowFlowDF['{}Q'.format(n)] = low
+
+    return( LowFlowDF )
+
+def GetLowFlowFrequency( LowFlowDF, returnPeriods=(2, 5, 10, 20, 50) ):
+    """This function estimates low flows with the given return periods (in
+    years) from the annual n-day low flows returned by GetLowFlowSeries, by
+    fitting a log-Pearson type III distribution to each column.  All columns
+    and return periods are fitted at once with vectorized moments, using the
+    sample mean, standard deviation and bias-corrected skew of the log10
+    flows.  Years that are NaN, such as incomplete years, are left out of
+    the fit.  Years with zero flow are left out of the fit and handled with
+    the conditional probability adjustment, so that a return period whose
+    non-exceedance probability falls within the fraction of zero years has
+    a low flow of zero.  The routine returns a DataFrame with one row per
+    return period and one column per window, e.g. row 10 of column "7Q" is
+    the 7Q10."""
+
+    # log flows of the years with flow, ignoring missing years
+    Q = LowFlowDF.values.astype(np.float64)
+    have = ~np.isnan(Q)
+    positive = have & (Q > 0)
+    logQ = np.where(positive, np.log10(np.where(positive, Q, 1.0)), np.nan)
+
+    # moments of each column
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = positive.sum(axis=0)
+        mean = np.nanmean(logQ, axis=0)
+        std = np.nanstd(logQ, axis=0, ddof=1)
+        dev = (logQ - mean)/std
+        skew = n*np.nansum(dev**3, axis=0)/((n - 1)*(n - 2))
+
+        # non-exceedance probabilities adjusted for the years of zero flow
+        zero = 1 - n/have.sum(axis=0)
+        p = 1/np.asarray(returnPeriods, dtype=np.float64)[:, None]
+        pAdjusted = (p - zero)/(1 - zero)
+
+        # log-Pearson type III quantiles
+        K = stats.pearson3.ppf(np.clip(pAdjusted, 0, 1), skew)
+        xQy = 10**(mean + K*std)
+        xQy = np.where(pAdjusted <= 0, 0.0, xQy)
+        xQy[:, n < 3] = np.nan
+
+    FrequencyDF = pd.DataFrame(xQy, index=pd.Index(returnPeriods, name='Return Period'),
+                               columns=LowFlowDF.columns)
+
+    return( FrequencyDF )
@@ -0,0 +1,165 @@
+#!/bin/env python
+#
+# This module provides opt-in instrumentation for the stages and metrics of
+# program_10.py.  Functions wrapped with Instrument, and blocks run inside
+# Profile.Stage, record their wall time, number of calls, rows processed
+# and (optionally) peak memory allocated, tagged with the station being
+# processed.  Profile.Report returns the records as a DataFrame, and
+# Profile.WriteReport writes them as JSON together with optional cProfile
+# and tracemalloc dumps.  While profiling is disabled, the default, an
+# instrumented function costs one extra attribute check per call.
+#
+#
+import contextlib
+import cProfile
+import functools
+import json
+import time
+import tracemalloc
+import pandas as pd
+import numpy as np
+
+class Profiler:
+    """This class collects the timing records of instrumented stages.  Use
+    the module's Profile instance rather than creating new ones."""
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.profile = None
+        self.snapshot = None
+        self.station = None
+        self.records = {}
+        self.stack = []
+
+    def Enable(self, memory=False, cprofile=False):
+        """Starts recording.  With memory, peak allocations are traced with
+        tracemalloc (which slows the code down); with cprofile, everything
+        run while enabled is also profiled with cProfile."""
+        self.enabled = True
+        self.memory = memory
+        self.snapshot = None
+        self.profile = None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    def Disable(self):
+        """Stops recording, keeping the records collected so far and, when
+        memory was traced, a tracemalloc snapshot for WriteReport."""
+        self.enabled = False
+        if self.profile is not None:
+            self.profile.disable()
+        if self.memory and tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def Reset(self):
+        """Clears the records."""
+        self.records = {}
+
+    @contextlib.contextmanager
+    def Station(self, name):
+        """Tags the records made inside the block with a station name."""
+        previous = self.station
+        self.station = name
+        try:
+            yield
+        finally:
+            self.station = previous
+
+    @contextlib.contextmanager
+    def Stage(self, name, rows=0):
+        """Records the block as one call of the stage name that processed
+        the given number of rows."""
+        if not self.enabled:
+            yield
+            return
+        self.Enter()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.Exit(name, time.perf_counter() - start, rows)
+
+    def Enter(self):
+        # keep the peak seen so far by the enclosing stage before the peak
+        # is reset for this one
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak - self.stack[-1][0])
+            tracemalloc.reset_peak()
+            self.stack.append([current, 0])
+
+    def Exit(self, name, seconds, rows):
+        record = self.records.setdefault((self.station, name),
+                                         {'calls': 0, 'seconds': 0.0, 'rows': 0, 'peak_bytes': None})
+        record['calls'] += 1
+        record['seconds'] += seconds
+        record['rows'] += int(rows)
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            base, seen = self.stack.pop()
+            peak = max(seen, peak - base)
+            record['peak_bytes'] = max(record['peak_bytes'] or 0, peak)
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak + base - self.stack[-1][0])
+
+    def Report(self):
+        """Returns a DataFrame with one row per station and stage."""
+        rows = [dict(Station=station, Stage=stage, **record)
+                for (station, stage), record in self.records.items()]
+        Report = pd.DataFrame(rows, columns=['Station', 'Stage', 'calls', 'seconds', 'rows', 'peak_bytes'])
+        return( Report )
+
+    def WriteReport(self, fileName, profileFile=None, snapshotFile=None):
+        """Writes the records to fileName as JSON (unless it is None), the
+        cProfile statistics to profileFile and a tracemalloc snapshot to
+        snapshotFile (when given and available: taken now while tracing,
+        or else the one taken by Disable)."""
+        if fileName is not None:
+            Report = self.Report().replace({np.nan: None})
+            with open(fileName, 'w') as f:
+                json.dump(Report.to_dict(orient='records'), f, indent=2)
+        if profileFile is not None and self.profile is not None:
+            self.profile.dump_stats(profileFile)
+        if snapshotFile is not None:
+            snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else self.snapshot
+            if snapshot is not None:
+                snapshot.dump(snapshotFile)
+
+# the profiler used by all instrumented functions
+Profile = Profiler()
+
+def CountRows( args, result ):
+    """Returns the rows processed by a call: the length of its first
+    DataFrame, Series or array argument, or else of its result (or the
+    first item of a tuple result)."""
+
+    for value in list(args) + [result[0] if isinstance(result, tuple) and result else result]:
+        if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+            return( len(value) )
+
+    return( 0 )
+
+def Instrument( func ):
+    """This decorator records every call of func as a stage named after the
+    function while profiling is enabled."""
+
+    @functools.wraps(func)
+    def Wrapper(*args, **kwargs):
+        if not Profile.enabled:
+            return( func(*args, **kwargs) )
+        Profile.Enter()
+        start = time.perf_counter()
+        result = None
+        try:
+            result = func(*args, **kwargs)
+            return( result )
+        finally:
+            Profile.Exit(func.__name__, time.perf_counter() - start, CountRows(args, result))
+
+    return( Wrapper )
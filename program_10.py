@@ -10,11 +10,32 @@
 # details about the assignment.
 #
 #
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+import traceback
 import pandas as pd
-import scipy.stats as stats
 import numpy as np
 
-def ReadData( fileName ):
+from profiling import Profile, Instrument
+
+# options that change how ReadData parses a file, part of every cache key:
+# the arguments given to read_csv and whether negative flows are removed
+ReadOptions = {'version': 2,
+               'read_csv': {'header': 1, 'delimiter': r"\s+", 'comment': '#', 'na_values': ['Eqp']},
+               'mask_negative': True}
+
+# USGS data-value qualification codes counted by GetDataQuality: approved,
+# provisional, estimated and revised
+QualityFlags = ['A', 'P', 'e', 'R']
+
+@Instrument
+def ReadData( fileName, cacheDir=None, cacheSize=256*2**20, quality=False ):
     """This function takes a filename as input, and returns a dataframe with
     raw data read from that file in a Pandas DataFrame.  The DataFrame index
     should be the year, month and day of the observation.  DataFrame headers
@@ -24,40 +45,488 @@ def ReadData( fileName ):
     help identifying other flags used by the USGS to indicate no data is 
     availabiel.  Function returns the completed DataFrame, and a dictionary 
     designed to contain all missing value counts that is initialized with
-    days missing between the first and last date of the file."""
+    days missing between the first and last date of the file.
+
+    If cacheDir is given, the parsed columns are also stored there in a
+    binary cache keyed by the hash of the file contents and ReadOptions, so
+    later calls on an unchanged file load the arrays without parsing.  The
+    cache is kept below cacheSize bytes by evicting least recently used
+    entries.
+
+    With quality, the completeness, gaps and qualification codes of the
+    record are also summarized by GetDataQuality from the parsed (or
+    cached) columns as part of the read, and kept in DataDF.attrs['Quality']
+    for ClipData and the statistics functions."""
     
+    # use the cached copy of the file if there is one
+    key = None
+    if cacheDir is not None:
+        with Profile.Stage('ReadData.cache'):
+            key = CacheKey(fileName)
+            DataDF = ReadCache(cacheDir, key)
+        if DataDF is not None:
+            if quality:
+                with Profile.Stage('ReadData.quality', rows=len(DataDF)):
+                    DataDF.attrs['Quality'] = GetDataQuality(DataDF)
+            return( DataDF, DataDF["Discharge"].isna().sum() )
+
     # define column names
     colNames = ['agency_cd', 'site_no', 'Date', 'Discharge', 'Quality']
 
     # open and read the file
-    DataDF = pd.read_csv(fileName, header=1, names=colNames,  
-                         delimiter=r"\s+",parse_dates=[2], comment='#',
-                         na_values=['Eqp'])
+    with Profile.Stage('ReadData.parse'):
+        DataDF = pd.read_csv(fileName, names=colNames, parse_dates=[2],
+                             **ReadOptions['read_csv'])
     DataDF = DataDF.set_index('Date')
     
     # Replace negative values
-    DataDF['Discharge'] = DataDF['Discharge'].mask(DataDF['Discharge']<0, np.nan)
+    if ReadOptions['mask_negative']:
+        DataDF['Discharge'] = DataDF['Discharge'].mask(DataDF['Discharge']<0, np.nan)
     
+    # store the parsed columns for the next run
+    if key is not None:
+        WriteCache(cacheDir, key, DataDF, fileName, cacheSize)
+
+    # summarize completeness and quality codes
+    if quality:
+        with Profile.Stage('ReadData.quality', rows=len(DataDF)):
+            DataDF.attrs['Quality'] = GetDataQuality(DataDF)
+
     # quantify the number of missing values
     MissingValues = DataDF["Discharge"].isna().sum()
     
     return( DataDF, MissingValues )
 
+def CacheKey( fileName ):
+    """This function returns the cache key of a data file, the SHA-256 hash
+    of its contents together with the ReadOptions used to parse it."""
+
+    digest = hashlib.sha256(json.dumps(ReadOptions, sort_keys=True).encode())
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+
+    return( digest.hexdigest() )
+
+def ReadCache( cacheDir, key ):
+    """This function loads the DataFrame stored under key in cacheDir by
+    WriteCache.  The column arrays are memory-mapped .npy files, so no text
+    is parsed.  Function returns the DataFrame, or None if the key is not
+    in the cache."""
+
+    entry = os.path.join(cacheDir, key)
+    try:
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r')
+                  for name in ['Day', 'Discharge', 'agency_cd', 'site_no', 'Quality']}
+
+        # mark the entry as recently used for the eviction policy (another
+        # process may have evicted it meanwhile, which is a miss)
+        os.utime(os.path.join(entry, 'meta.json'))
+    except (OSError, ValueError):
+        return( None )
+
+    # rebuild the columns with the dtypes ReadData returns
+    DataDF = pd.DataFrame(index=pd.DatetimeIndex(arrays['Day'].astype('datetime64[D]'), name='Date'))
+    for col in ['agency_cd', 'site_no', 'Discharge', 'Quality']:
+        if col == 'Discharge':
+            DataDF[col] = np.array(arrays[col])
+        else:
+            values = np.asarray(pd.Categorical.from_codes(np.array(arrays[col]), meta['categories'][col]), dtype=object)
+            DataDF[col] = values.astype(meta['dtypes'][col])
+
+    return( DataDF )
+
+def WriteCache( cacheDir, key, DataDF, fileName, cacheSize ):
+    """This function stores the columns of a DataFrame returned by ReadData
+    in cacheDir under key, as one .npy file per column: int32 day offsets,
+    float64 discharge and integer codes of the text columns.  Older entries
+    made from the same source file are removed, and the least recently used
+    entries are evicted until the cache is no larger than cacheSize bytes."""
+
+    entry = os.path.join(cacheDir, key)
+    tmp = entry + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+
+    # write the columns and the metadata needed to rebuild them
+    source = os.path.abspath(fileName)
+    meta = {'source': source, 'categories': {}, 'dtypes': {}}
+    np.save(os.path.join(tmp, 'Day.npy'), DataDF.index.values.astype('datetime64[D]').astype(np.int32))
+    np.save(os.path.join(tmp, 'Discharge.npy'), DataDF['Discharge'].values.astype(np.float64))
+    for col in ['agency_cd', 'site_no', 'Quality']:
+        values = pd.Categorical(DataDF[col])
+        np.save(os.path.join(tmp, col + '.npy'), values.codes)
+        meta['categories'][col] = values.categories.tolist()
+        meta['dtypes'][col] = str(DataDF[col].dtype)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # move the finished entry into place
+    shutil.rmtree(entry, ignore_errors=True)
+    os.replace(tmp, entry)
+
+    # invalidate stale entries and evict the least recently used ones
+    entries = []
+    for name in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, name)
+        if '.tmp' in name:
+            continue
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                stale = name != key and json.load(f)['source'] == source
+            used = os.path.getmtime(os.path.join(path, 'meta.json'))
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        except (OSError, ValueError, KeyError):
+            continue
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            entries.append((used, size, path))
+    total = sum(size for used, size, path in entries)
+    for used, size, path in sorted(entries):
+        if total <= cacheSize or path == entry:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+@Instrument
 def ClipData( DataDF, startDate, endDate ):
     """This function clips the given time series dataframe to a given range 
     of dates. Function returns the clipped dataframe and and the number of 
     missing values."""
     
-    #Clip data within the time period
-    DataDF.index = pd.to_datetime(DataDF.index)
-    mask = (DataDF.index >= startDate) & (DataDF.index <= endDate)
-    DataDF = DataDF.loc[mask]
+    # parse the index only if it is not dates already, without changing the
+    # caller's dataframe
+    if not isinstance(DataDF.index, pd.DatetimeIndex):
+        with Profile.Stage('ClipData.to_datetime', rows=len(DataDF)):
+            DataDF = DataDF.set_axis(pd.to_datetime(DataDF.index), axis=0)
+
+    #Clip data within the time period, by binary search of a sorted index
+    if DataDF.index.is_monotonic_increasing:
+        first = DataDF.index.searchsorted(pd.Timestamp(startDate), side='left')
+        last = DataDF.index.searchsorted(pd.Timestamp(endDate), side='right')
+        DataDF = DataDF.iloc[first:last]
+    else:
+        mask = (DataDF.index >= startDate) & (DataDF.index <= endDate)
+        DataDF = DataDF.loc[mask]
+
+    # trim the quality summary of the record to the clipped dates, if it
+    # was summarized
+    if 'Quality' in DataDF.attrs:
+        with Profile.Stage('ClipData.quality', rows=len(DataDF)):
+            DataDF.attrs['Quality'] = ClipDataQuality(DataDF.attrs['Quality'], DataDF, startDate, endDate)
     
     # quantify the number of missing values
     MissingValues = DataDF["Discharge"].isna().sum()
     
     return( DataDF, MissingValues )
 
+class PeriodIndex:
+    """This class holds the periods of each day of a daily record, computed
+    once per station and shared by the annual, monthly and seasonal
+    aggregations: integer water-year codes (yearCodes, 0 for the first
+    water year of the record), month codes (monthCodes, 0 for the first
+    month), the calendar month (month, 1-12) and the day of the water year
+    (dayOfYear, 0 on October 1) of every day, the start date of every water
+    year (yearIndex) and month (monthIndex), and the offsets of the days of
+    each water year and month (yearOffsets, monthOffsets; group i is rows
+    offsets[i] to offsets[i+1] of a record in date order).  Water years are
+    numbered by the calendar year in which they start."""
+
+    def __init__(self, dates):
+        if not isinstance(dates, pd.DatetimeIndex):
+            dates = pd.DatetimeIndex(dates)
+        self.name = dates.name
+
+        # months since 1970-01 give the calendar year and month of each day
+        days = dates.values.astype('datetime64[D]')
+        months = days.astype('datetime64[M]').astype(np.int64)
+        self.month = months % 12 + 1
+        waterYear = months//12 + 1970 + (self.month >= 10) - 1
+
+        # codes offset from the first water year and month
+        self.firstYear = int(waterYear.min())
+        self.yearCodes = waterYear - self.firstYear
+        self.nYears = int(self.yearCodes.max()) + 1
+        self.firstMonth = int(months.min())
+        self.monthCodes = months - self.firstMonth
+        self.nMonths = int(self.monthCodes.max()) + 1
+
+        # day of the water year, from the October 1 it starts on
+        start = ((waterYear - 1970)*12 + 9).astype('datetime64[M]').astype('datetime64[D]')
+        self.dayOfYear = (days - start).astype(np.int64)
+
+        # start date of each period
+        self.yearIndex = pd.DatetimeIndex(((self.firstYear - 1970 + np.arange(self.nYears))*12 + 9)
+                                          .astype('datetime64[M]').astype('datetime64[ns]'), name=self.name)
+        self.monthIndex = pd.DatetimeIndex((self.firstMonth + np.arange(self.nMonths))
+                                           .astype('datetime64[M]').astype('datetime64[ns]'), name=self.name)
+
+        # offsets of the days of each period
+        self.yearOffsets = np.concatenate(([0], np.cumsum(np.bincount(self.yearCodes, minlength=self.nYears))))
+        self.monthOffsets = np.concatenate(([0], np.cumsum(np.bincount(self.monthCodes, minlength=self.nMonths))))
+
+    def SeasonCodes(self, seasons):
+        """Returns the season of every day as an integer code, the position
+        of its season in seasons (a dictionary of season names and lists
+        of calendar months, e.g. {'DJF': [12, 1, 2], ...}), or -1 for days
+        in no season."""
+        lookup = np.full(13, -1)
+        for i, months in enumerate(seasons.values()):
+            lookup[list(months)] = i
+        return( lookup[self.month] )
+
+def GetDataQuality( DataDF ):
+    """This function summarizes the completeness and qualification codes of
+    a daily streamflow record, for every water year and month that the
+    record touches.  Missing days are days with a NoData value and dates
+    absent from the record, so periods are measured against the full
+    calendar.  Qualification codes such as "A:e" are split into the flags
+    in QualityFlags.  All tables come from one pass of array operations
+    over a daily calendar of the record.  The routine returns a dictionary
+    of DataFrames: "Annual" and "Monthly" with one row per period and the
+    columns "Days" (calendar days), "Present" (dates in the record),
+    "Valid" (days with a value), "Completeness" (Valid/Days), "Longest Gap"
+    (longest run of missing days) and the fraction of the valid days
+    flagged with each code ("A", "P", "e", "R"); and "Gaps" with one row
+    per run of missing days within the record and the columns "Start",
+    "End", "Days" and "Absent Days" (dates of the run absent from the
+    record).  A record without dates gives empty tables."""
+
+    # empty tables for an empty record, e.g. an RDB file with only a header
+    columns = ['Days', 'Present', 'Valid', 'Completeness', 'Longest Gap'] + QualityFlags
+    if len(DataDF) == 0:
+        index = pd.DatetimeIndex([], name=DataDF.index.name)
+        return( {'Annual': pd.DataFrame(columns=columns, index=index),
+                 'Monthly': pd.DataFrame(columns=columns, index=index),
+                 'Gaps': pd.DataFrame(columns=['Start', 'End', 'Days', 'Absent Days'])} )
+
+    # daily calendar of the water years touched by the record
+    day = DataDF.index.values.astype('datetime64[D]')
+    first = pd.Timestamp(day.min())
+    first = pd.Timestamp(first.year - (first.month < 10), 10, 1)
+    last = pd.Timestamp(day.max())
+    last = pd.Timestamp(last.year + (last.month >= 10), 9, 30)
+    calendar = pd.date_range(first, last, freq='D', name=DataDF.index.name)
+    periods = PeriodIndex(calendar)
+    column = (day - np.datetime64(first.date(), 'D')).astype(np.int64)
+
+    # days present, with a value, and with each flag
+    present = np.zeros(len(calendar), dtype=bool)
+    present[column] = True
+    valid = np.zeros(len(calendar), dtype=bool)
+    valid[column] = ~np.isnan(DataDF['Discharge'].values.astype(np.float64))
+    codes, labels = pd.factorize(DataDF['Quality']) if 'Quality' in DataDF.columns else \
+        (np.full(len(DataDF), -1), [])
+    flags = {}
+    for flag in QualityFlags:
+        lookup = np.array([flag in str(label).split(':') for label in labels] + [False])
+        flags[flag] = np.zeros(len(calendar), dtype=bool)
+        flags[flag][column] = lookup[codes] & valid[column]
+
+    # length of the run of missing days up to each day, within its period
+    position = np.arange(len(calendar))
+    lastValid = np.maximum.accumulate(np.where(valid, position, -1))
+
+    Quality = {}
+    for table, codes, offsets, index in [('Annual', periods.yearCodes, periods.yearOffsets, periods.yearIndex),
+                                         ('Monthly', periods.monthCodes, periods.monthOffsets, periods.monthIndex)]:
+        starts = offsets[:-1]
+        run = np.where(valid, 0, position - np.maximum(lastValid, offsets[codes] - 1))
+        Table = pd.DataFrame({'Days': np.diff(offsets),
+                              'Present': np.add.reduceat(present.astype(np.int64), starts),
+                              'Valid': np.add.reduceat(valid.astype(np.int64), starts)}, index=index)
+        Table['Completeness'] = Table['Valid']/Table['Days']
+        Table['Longest Gap'] = np.maximum.reduceat(run, starts)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for flag in QualityFlags:
+                Table[flag] = np.add.reduceat(flags[flag].astype(np.int64), starts)/Table['Valid'].values
+        Quality[table] = Table
+
+    # runs of missing days between the first and last date of the record
+    missing = ~valid
+    missing[:column.min()] = False
+    missing[column.max() + 1:] = False
+    edges = np.diff(np.concatenate(([0], missing.astype(np.int8), [0])))
+    runStart = np.flatnonzero(edges == 1)
+    runEnd = np.flatnonzero(edges == -1) - 1
+    absent = np.concatenate(([0], np.cumsum(~present)))
+    Quality['Gaps'] = pd.DataFrame({'Start': calendar[runStart], 'End': calendar[runEnd],
+                                    'Days': runEnd - runStart + 1,
+                                    'Absent Days': absent[runEnd + 1] - absent[runStart]})
+
+    return( Quality )
+
+def ClipDataQuality( Quality, DataDF, startDate, endDate ):
+    """This function trims the tables of GetDataQuality to a record clipped
+    to the dates from startDate to endDate, DataDF, without a second pass
+    over the record.  Water years and months wholly inside the clip are
+    sliced from Quality; only the water years that the clip cuts into are
+    summarized again, from their days in DataDF.  Runs of missing days
+    are cut to the first and last date of DataDF.  The routine returns the
+    tables of GetDataQuality(DataDF)."""
+
+    if len(DataDF) == 0:
+        return( GetDataQuality(DataDF) )
+
+    # water years of the clipped record, numbered by the year they start
+    first = DataDF.index.min()
+    last = DataDF.index.max()
+    firstYear = first.year - (first.month < 10)
+    lastYear = last.year - (last.month < 10)
+
+    # summarize again the water years at the ends that the clip cuts into,
+    # from their days, and slice the years in between from Quality
+    Tables = {'Annual': [], 'Monthly': []}
+    for year in sorted({firstYear, lastYear}):
+        start = pd.Timestamp(year, 10, 1)
+        end = pd.Timestamp(year + 1, 9, 30)
+        if pd.Timestamp(startDate) <= start and pd.Timestamp(endDate) >= end:
+            continue
+        Edge = GetDataQuality(DataDF.loc[(DataDF.index >= start) & (DataDF.index <= end)])
+        for table in Tables:
+            Tables[table].append(Edge[table])
+        if year == firstYear:
+            firstYear += 1
+        else:
+            lastYear -= 1
+    start = pd.Timestamp(firstYear, 10, 1)
+    end = pd.Timestamp(lastYear + 1, 9, 1)
+    Clipped = {table: pd.concat([Quality[table].loc[start:end]] + Tables[table]).sort_index()
+               if Tables[table] else Quality[table].loc[start:end] for table in Tables}
+
+    # runs of missing days cut to the clipped record, recounting the dates
+    # absent from the cut runs
+    Gaps = Quality['Gaps']
+    Gaps = Gaps.loc[(Gaps['End'] >= first) & (Gaps['Start'] <= last)].reset_index(drop=True)
+    cut = ((Gaps['Start'] < first) | (Gaps['End'] > last)).values
+    if cut.any():
+        Gaps['Start'] = Gaps['Start'].clip(lower=first)
+        Gaps['End'] = Gaps['End'].clip(upper=last)
+        Gaps['Days'] = (Gaps['End'] - Gaps['Start']).dt.days + 1
+        for i in np.flatnonzero(cut):
+            present = ((DataDF.index >= Gaps.at[i, 'Start']) & (DataDF.index <= Gaps.at[i, 'End'])).sum()
+            Gaps.at[i, 'Absent Days'] = Gaps.at[i, 'Days'] - present
+    Clipped['Gaps'] = Gaps
+
+    return( Clipped )
+
+def DayOffset( date ):
+    """This function converts a date (string, Timestamp or datetime64) into
+    an integer number of days since 1970-01-01, the day offset used by the
+    compact chunks returned from ReadDataChunks."""
+
+    return( int(np.datetime64(pd.Timestamp(date).date(), 'D').astype(np.int64)) )
+
+def ReadDataChunks( fileName, startDate=None, endDate=None, chunkSize=100000,
+                    dtype=np.float64 ):
+    """This function is a streaming version of ReadData and ClipData.  It
+    reads a USGS RDB file (single or multi-site) chunkSize rows at a time
+    and yields each chunk as a compact DataFrame with columns "site_no" and
+    "Quality" (small categoricals), "Day" (int32 days since 1970-01-01) and
+    "Discharge" (dtype, float64 by default).  As in ReadData, "Eqp" and any
+    other non-numeric flags and negative values are replaced with np.NaN,
+    and, as in ClipData, only rows between startDate and endDate (inclusive,
+    either may be None) are kept.  Repeated header lines found in multi-site
+    files are skipped."""
+
+    # define column names, only the agency column is never loaded
+    colNames = ['agency_cd', 'site_no', 'Date', 'Discharge', 'Quality']
+
+    # clip limits as day offsets
+    first = -2**31 if startDate is None else DayOffset(startDate)
+    last = 2**31 - 1 if endDate is None else DayOffset(endDate)
+
+    # open the file and read it one chunk at a time as text
+    reader = pd.read_csv(fileName, header=1, names=colNames,
+                         delimiter=r"\s+", comment='#', dtype=str,
+                         usecols=colNames[1:], chunksize=chunkSize)
+    for chunk in reader:
+
+        # convert dates to day offsets, dropping repeated header lines
+        dates = pd.to_datetime(chunk['Date'], format='%Y-%m-%d', errors='coerce')
+        Day = dates.values.astype('datetime64[D]').astype(np.int64)
+        keep = dates.notna().values & (Day >= first) & (Day <= last)
+        if not keep.any():
+            continue
+
+        # replace flags and negative values
+        Discharge = pd.to_numeric(chunk['Discharge'].values[keep], errors='coerce').astype(dtype)
+        Discharge[Discharge < 0] = np.nan
+
+        yield pd.DataFrame({'site_no': pd.Categorical(chunk['site_no'].values[keep]),
+                            'Day': Day[keep].astype(np.int32),
+                            'Discharge': Discharge,
+                            'Quality': pd.Categorical(chunk['Quality'].values[keep])})
+
+@Instrument
+def GetStreamStatistics( chunks ):
+    """This function calculates the annual and monthly statistics of
+    GetAnnualStatistics and GetMonthlyStatistics from the compact chunks
+    yielded by ReadDataChunks, without building the full record in memory.
+    Rows of each site are buffered only until their water year is complete,
+    so each site's rows must be contiguous and in date order, as in NWIS
+    output.  The routine returns a dictionary, keyed by site number, of
+    (WYDataDF, MoDataDF) tuples."""
+
+    WYData = {}
+    MoData = {}
+
+    def Flush( site, pieces ):
+        # calculate the statistics of a set of complete water years
+        Block = pd.concat(pieces, ignore_index=True)
+        DataDF = pd.DataFrame({'site_no': int(site),
+                               'Discharge': Block['Discharge'].values.astype(np.float64)},
+                              index=pd.DatetimeIndex(Block['Day'].values.astype('datetime64[D]'), name='Date'))
+        periods = PeriodIndex(DataDF.index)
+        WYData.setdefault(site, []).append(GetAnnualStatistics(DataDF, periods))
+        MoData.setdefault(site, []).append(GetMonthlyStatistics(DataDF, periods))
+
+    site = None
+    pieces = []
+    for chunk in chunks:
+
+        # split the chunk where the site changes
+        codes = chunk['site_no'].cat.codes.values
+        breaks = np.concatenate(([0], np.flatnonzero(np.diff(codes)) + 1, [len(chunk)]))
+        for i in range(len(breaks) - 1):
+            piece = chunk.iloc[breaks[i]:breaks[i+1]]
+            if piece['site_no'].iloc[0] != site:
+                if pieces:
+                    Flush(site, pieces)
+                site = piece['site_no'].iloc[0]
+                pieces = []
+            pieces.append(piece)
+
+        # water year (by starting calendar year) of each buffered day
+        Day = np.concatenate([p['Day'].values for p in pieces]).astype('datetime64[D]')
+        year = Day.astype('datetime64[Y]').astype(np.int64) + 1970
+        month = Day.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        year = year + (month >= 10) - 1
+
+        # calculate statistics for the water years that are complete
+        done = int(np.searchsorted(year, year[-1]))
+        if done > 0:
+            Buffer = pd.concat(pieces, ignore_index=True)
+            Flush(site, [Buffer.iloc[:done]])
+            pieces = [Buffer.iloc[done:]]
+    if pieces:
+        Flush(site, pieces)
+
+    # join the blocks of each site into complete tables
+    Results = {}
+    for site in WYData.keys():
+        WYDataDF = pd.concat(WYData[site])
+        MoDataDF = pd.concat(MoData[site])
+        years = range(WYDataDF.index.year.min(), WYDataDF.index.year.max() + 1)
+        WYDataDF = WYDataDF.reindex(pd.DatetimeIndex([pd.Timestamp(y, 10, 1) for y in years], name='Date'))
+        MoDataDF = MoDataDF.reindex(pd.date_range(MoDataDF.index.min(), MoDataDF.index.max(), freq='MS', name='Date'))
+        Results[site] = ( WYDataDF, MoDataDF )
+
+    return( Results )
+
+@Instrument
 def CalcTqmean(Qvalues):
     """This function computes the Tqmean of a series of data, typically
        a 1 year time series of streamflow, after filtering out NoData
@@ -74,6 +543,7 @@ def CalcTqmean(Qvalues):
     
     return ( Tqmean )
 
+@Instrument
 def CalcRBindex(Qvalues):
     """This function computes the Richards-Baker Flashiness Index
        (R-B Index) of an array of values, typically a 1 year time
@@ -100,6 +570,7 @@ def CalcRBindex(Qvalues):
     
     return ( RBindex )
 
+@Instrument
 def Calc7Q(Qvalues):
     """This function computes the seven day low flow of an array of 
        values, typically a 1 year time series of streamflow, after 
@@ -117,6 +588,7 @@ def Calc7Q(Qvalues):
     
     return ( val7Q )
 
+@Instrument
 def CalcExceed3TimesMedian(Qvalues):
     """This function computes the number of days with flows greater 
        than 3 times the annual median flow. The index is calculated by 
@@ -136,59 +608,474 @@ def CalcExceed3TimesMedian(Qvalues):
     
     return ( median3x )
 
-def GetAnnualStatistics(DataDF):
-    """This function calculates annual descriptive statistcs and metrics for 
+class MetricGraph:
+    """This class evaluates streamflow metrics for every group of a record
+    (e.g. every water year or month) lazily.  Each metric and each shared
+    intermediate (the clean values, counts, totals, mean, deviations,
+    moments, std, sorted values, median and day-to-day changes) is a node
+    that declares the nodes it is computed from in Nodes.  A node is
+    computed at most once, when first needed, with vectorized NumPy group
+    reductions, so requesting a subset of the metrics only computes what
+    that subset needs.  Qvalues is the daily discharge array in time order
+    and codes is an integer array of the same length giving the group (0 to
+    nGroups-1) of each day."""
+
+    # node name: (method computing it, names of the nodes it depends on)
+    Nodes = {'valid':       ('Valid', ()),
+             'clean':       ('Clean', ('valid',)),
+             'group':       ('Group', ('valid',)),
+             'missing':     ('Missing', ('valid',)),
+             'count':       ('Count', ('group',)),
+             'start':       ('Start', ('count',)),
+             'total':       ('Total', ('clean', 'group')),
+             'mean':        ('Mean', ('total', 'count')),
+             'deviation':   ('Deviation', ('clean', 'group', 'mean')),
+             'm2':          ('Moment2', ('deviation', 'group')),
+             'm3':          ('Moment3', ('deviation', 'group')),
+             'std':         ('Std', ('m2', 'count')),
+             'sorted':      ('Sorted', ('clean', 'group')),
+             'median':      ('Median', ('sorted', 'start', 'count')),
+             'diffs':       ('Diffs', ('clean', 'group')),
+             'Mean Flow':   ('MeanFlow', ('mean',)),
+             'Peak Flow':   ('PeakFlow', ('clean', 'start', 'count')),
+             'Median Flow': ('MedianFlow', ('median',)),
+             'Coeff Var':   ('CoeffVar', ('std', 'mean')),
+             'Skew':        ('Skew', ('m2', 'm3', 'mean', 'count', 'missing')),
+             'Tqmean':      ('Tqmean', ('clean', 'group', 'mean', 'count')),
+             'R-B Index':   ('RBindex', ('diffs', 'total', 'count')),
+             '7Q':          ('Low7Q', ('clean', 'group', 'start')),
+             '3xMedian':    ('Exceed3TimesMedian', ('clean', 'group', 'median'))}
+
+    # metrics in the order of the annual DataFrame columns
+    Metrics = ['Mean Flow', 'Peak Flow', 'Median Flow', 'Coeff Var', 'Skew',
+               'Tqmean', 'R-B Index', '7Q', '3xMedian']
+
+    def __init__(self, Qvalues, codes, nGroups):
+        self.Qvalues = np.asarray(Qvalues, dtype=np.float64)
+        self.codes = np.asarray(codes, dtype=np.int64)
+        self.nGroups = nGroups
+        self.values = {}
+
+        # make sure days are ordered by group while keeping time order in groups
+        if len(self.codes) > 1 and (np.diff(self.codes) < 0).any():
+            order = np.argsort(self.codes, kind='stable')
+            self.Qvalues = self.Qvalues[order]
+            self.codes = self.codes[order]
+
+    def Get(self, name):
+        """Returns the value of a node, computing it and the nodes it
+        depends on the first time it is needed."""
+        if name not in self.values:
+            method, depends = self.Nodes[name]
+            args = [self.Get(d) for d in depends]
+            if Profile.enabled:
+                with Profile.Stage('MetricGraph.' + name, rows=len(self.Qvalues)), \
+                        np.errstate(divide='ignore', invalid='ignore'):
+                    self.values[name] = getattr(self, method)(*args)
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    self.values[name] = getattr(self, method)(*args)
+        return( self.values[name] )
+
+    def Evaluate(self, metrics=None):
+        """Returns a dictionary of the requested metrics (all by default)."""
+        return( {name: self.Get(name) for name in (metrics or self.Metrics)} )
+
+    # Drop None values once for all metrics
+    def Valid(self):
+        return( ~np.isnan(self.Qvalues) )
+
+    def Clean(self, valid):
+        return( self.Qvalues[valid] )
+
+    def Group(self, valid):
+        return( self.codes[valid] )
+
+    def Missing(self, valid):
+        return( np.bincount(self.codes[~valid], minlength=self.nGroups) )
+
+    # group sizes and start offsets of the clean values
+    def Count(self, group):
+        return( np.bincount(group, minlength=self.nGroups) )
+
+    def Start(self, count):
+        return( np.concatenate(([0], np.cumsum(count)[:-1])) )
+
+    # moments of each group
+    def Total(self, clean, group):
+        return( np.bincount(group, weights=clean, minlength=self.nGroups) )
+
+    def Mean(self, total, count):
+        return( total/count )
+
+    def Deviation(self, clean, group, mean):
+        return( clean - mean[group] )
+
+    def Moment2(self, deviation, group):
+        return( np.bincount(group, weights=deviation**2, minlength=self.nGroups) )
+
+    def Moment3(self, deviation, group):
+        return( np.bincount(group, weights=deviation**3, minlength=self.nGroups) )
+
+    def Std(self, m2, count):
+        std = np.sqrt(m2/(count - 1))
+        std[count < 2] = np.nan
+        return( std )
+
+    # values sorted within each group, and the median from them
+    def Sorted(self, clean, group):
+        order = np.argsort(clean)
+        return( clean[order[np.argsort(group[order], kind='stable')]] )
+
+    def Median(self, sortedQ, start, count):
+        full = count > 0
+        median = np.full(self.nGroups, np.nan)
+        median[full] = (sortedQ[start[full] + (count[full] - 1)//2] + sortedQ[start[full] + count[full]//2])/2
+        return( median )
+
+    # absolute day-to-day changes within each group
+    def Diffs(self, clean, group):
+        same = group[1:] == group[:-1]
+        return( np.bincount(group[1:][same], weights=np.abs(np.diff(clean))[same],
+                            minlength=self.nGroups) )
+
+    def MeanFlow(self, mean):
+        return( mean )
+
+    def PeakFlow(self, clean, start, count):
+        full = count > 0
+        peak = np.full(self.nGroups, np.nan)
+        if full.any():
+            peak[full] = np.maximum.reduceat(clean, start[full])
+        return( peak )
+
+    def MedianFlow(self, median):
+        return( median )
+
+    def CoeffVar(self, std, mean):
+        return( (std/mean)*100 )
+
+    # scipy.stats.skew, NaN for groups containing NoData values
+    def Skew(self, m2, m3, mean, count, missing):
+        skew = (m3/count)/(m2/count)**1.5
+        skew[(missing > 0) | ~(m2 > (np.finfo(np.float64).eps*mean)**2*count)] = np.nan
+        return( skew )
+
+    # fraction of days exceeding the mean flow
+    def Tqmean(self, clean, group, mean, count):
+        return( np.bincount(group, weights=clean > mean[group], minlength=self.nGroups)/count )
+
+    def RBindex(self, diffs, total, count):
+        RBindex = diffs/total
+        RBindex[count == 0] = np.nan
+        return( RBindex )
+
+    # 7-day moving averages from a cumulative sum, keeping only windows
+    # that lie entirely inside one group
+    def Low7Q(self, clean, group, start):
+        cumQ = np.concatenate(([0.0], np.cumsum(clean)))
+        avg7 = (cumQ[7:] - cumQ[:-7])/7
+        end = np.arange(6, len(clean))
+        inside = (end - start[group[6:]]) >= 6
+        val7Q = np.full(self.nGroups, np.inf)
+        np.minimum.at(val7Q, group[6:][inside], avg7[inside])
+        val7Q[np.isinf(val7Q)] = np.nan
+        return( val7Q )
+
+    # days with flow greater than 3 times the median flow
+    def Exceed3TimesMedian(self, clean, group, median):
+        return( np.bincount(group, weights=clean > 3*median[group],
+                            minlength=self.nGroups).astype(np.int64) )
+
+@Instrument
+def CalcGroupedMetrics(Qvalues, codes, nGroups, metrics=None):
+    """This function computes the annual metrics (or the subset named in
+       metrics) for every group of a streamflow record in a single
+       vectorized pass over NumPy arrays, sharing intermediates through a
+       MetricGraph.  Qvalues is the daily discharge array in time order
+       and codes is an integer array of the same length giving the group
+       (0 to nGroups-1) of each day, e.g. the water year offset from the
+       first year.  Each metric reproduces the result of the matching Calc*
+       function (Skew follows scipy.stats.skew and is NaN for groups
+       containing NoData values).  The routine returns a dictionary of
+       arrays of length nGroups keyed by the DataFrame column names."""
+
+    return( MetricGraph(Qvalues, codes, nGroups).Evaluate(metrics) )
+
+class FlowDuration:
+    """This class is a flow-duration index of a streamflow record: the
+    daily values of each period (water year 'WY', calendar month 'M', or
+    the whole period of record 'POR'), without NoData values, sorted once
+    when the index is built.  Exceedance counts, exceedance flows and
+    threshold queries are then answered by binary search within each
+    period, in O(log n) per period and vectorized over all periods and
+    thresholds, without rescanning the daily series.  periods is the
+    PeriodIndex of DataDF, if already computed."""
+
+    def __init__(self, DataDF, period='WY', periods=None):
+
+        # group code and start date of each period
+        dates = DataDF.index
+        if period == 'POR':
+            codes = np.zeros(len(dates), dtype=np.int64)
+            labels = pd.DatetimeIndex([dates.min()], name=dates.name)
+        else:
+            if periods is None:
+                periods = PeriodIndex(dates)
+            codes = periods.yearCodes if period == 'WY' else periods.monthCodes
+            labels = periods.yearIndex if period == 'WY' else periods.monthIndex
+        self.index = labels
+
+        # sorted values, start offsets and counts of each period
+        self.graph = MetricGraph(DataDF['Discharge'].values, codes, len(labels))
+        self.sorted = self.graph.Get('sorted')
+        self.start = self.graph.Get('start')
+        self.count = self.graph.Get('count')
+
+    def Search(self, values, side='left'):
+        """Returns the number of values in each period that are less than
+        (side 'left') or less than or equal to (side 'right') values, a 2-D
+        array broadcast against one row per period, e.g. thresholds[None, :]
+        for thresholds shared by all periods or mean[:, None] for one value
+        per period."""
+        values = np.asarray(values, dtype=np.float64)
+        shape = np.broadcast_shapes((len(self.start), 1), values.shape)
+        lo = np.broadcast_to(self.start[:, None], shape).copy()
+        hi = lo + self.count[:, None]
+
+        # binary search of all periods and values together
+        while (lo < hi).any():
+            mid = (lo + hi)//2
+            active = lo < hi
+            midValue = self.sorted[np.minimum(mid, len(self.sorted) - 1)]
+            right = active & ((midValue < values) if side == 'left' else (midValue <= values))
+            lo = np.where(right, mid + 1, lo)
+            hi = np.where(active & ~right, mid, hi)
+
+        return( lo - self.start[:, None] )
+
+    def DaysAbove(self, thresholds):
+        """Returns a DataFrame of the number of days in each period with
+        flow greater than each threshold (one column per threshold)."""
+        thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+        counts = self.count[:, None] - self.Search(thresholds[None, :], side='right')
+        return( pd.DataFrame(counts, index=self.index, columns=thresholds) )
+
+    def ExceedanceFlow(self, percents=(10, 50, 90)):
+        """Returns a DataFrame of the flows exceeded the given percentages
+        of the time in each period (columns "Q10", "Q50", ...), linearly
+        interpolated between sorted values as in numpy.quantile."""
+        percents = np.atleast_1d(np.asarray(percents, dtype=np.float64))
+        position = (1 - percents[None, :]/100)*(self.count[:, None] - 1)
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, np.maximum(self.count[:, None] - 1, 0))
+        low = self.sorted[np.clip(self.start[:, None] + below, 0, max(len(self.sorted) - 1, 0))]
+        high = self.sorted[np.clip(self.start[:, None] + above, 0, max(len(self.sorted) - 1, 0))]
+        flows = low + (high - low)*(position - below)
+        flows[self.count == 0] = np.nan
+        return( pd.DataFrame(flows, index=self.index, columns=['Q{:g}'.format(p) for p in percents]) )
+
+    def Tqmean(self):
+        """Returns the Tqmean of each period, as CalcTqmean."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            days = self.count - self.Search(self.graph.Get('mean')[:, None], side='right')[:, 0]
+            return( pd.Series(days/self.count, index=self.index) )
+
+    def Exceed3TimesMedian(self):
+        """Returns the number of days above 3 times the median flow of each
+        period, as CalcExceed3TimesMedian."""
+        days = self.count - self.Search(3*self.graph.Get('median')[:, None], side='right')[:, 0]
+        return( pd.Series(days, index=self.index) )
+
+def GetStationMatrix( DataDFs, startDate, endDate ):
+    """This function puts the discharge of several stations into a 2-D
+    NumPy array for CalcBatchMetrics, with one row per station (in the
+    order of the DataDFs list or dictionary values) and one column per day
+    from startDate to endDate.  Days missing from a station are NaN.  The
+    routine returns the array and the DatetimeIndex of its columns."""
+
+    dates = pd.date_range(startDate, endDate, freq='D', name='Date')
+    if isinstance(DataDFs, dict):
+        DataDFs = list(DataDFs.values())
+    Qmatrix = np.full((len(DataDFs), len(dates)), np.nan)
+    for i, DataDF in enumerate(DataDFs):
+        Qmatrix[i] = DataDF['Discharge'].reindex(dates).values
+
+    return( Qmatrix, dates )
+
+def GetPeriodEdges( dates, period='WY' ):
+    """This function returns the column edges of the water years (period
+    'WY') or calendar months (period 'M') of a sorted DatetimeIndex, as an
+    integer array starting at 0 and ending at len(dates) that can be
+    passed to CalcBatchMetrics."""
+
+    periods = PeriodIndex(dates)
+    edges = np.unique(periods.yearOffsets if period == 'WY' else periods.monthOffsets)
+
+    return( edges )
+
+@Instrument
+def CalcBatchMetrics( Qmatrix, edges ):
+    """This function computes Mean Flow, Coeff Var, Skew, Tqmean, R-B Index
+    and 3xMedian for many stations at once.  Qmatrix is a 2-D array of daily
+    discharge with stations as rows and days as columns, NaN where a
+    station has no data (including padding), and edges are the column
+    boundaries of the periods (strictly increasing, from 0 to the number of
+    days, e.g. from GetPeriodEdges).  Every metric is a vectorized reduction
+    along the day axis; only the medians loop, once per period for all
+    stations.  NaN values are left out of every metric, as in the Calc*
+    functions, including Skew (unlike GetAnnualStatistics, where a period
+    with NoData values has a NaN skew).  The routine returns a dictionary
+    of stations x periods arrays keyed by the DataFrame column names."""
+
+    Q = np.asarray(Qmatrix, dtype=np.float64)
+    edges = np.asarray(edges, dtype=np.int64)
+    if len(edges) < 2 or edges[0] != 0 or edges[-1] != Q.shape[1] or (np.diff(edges) <= 0).any():
+        raise ValueError('edges must increase strictly from 0 to the number of days')
+    starts = edges[:-1]
+    lengths = np.diff(edges)
+    period = np.repeat(np.arange(len(starts)), lengths)
+
+    # Drop None values by giving them no weight
+    valid = ~np.isnan(Q)
+    Qz = np.where(valid, Q, 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # moments of each station and period
+        n = np.add.reduceat(valid, starts, axis=1)
+        total = np.add.reduceat(Qz, starts, axis=1)
+        mean = total/n
+        meanQ = np.repeat(mean, lengths, axis=1)
+        dev = np.where(valid, Q - meanQ, 0.0)
+        dev2 = dev*dev
+        m2 = np.add.reduceat(dev2, starts, axis=1)
+        m3 = np.add.reduceat(dev2*dev, starts, axis=1)
+        del dev, dev2
+        std = np.sqrt(m2/(n - 1))
+        std[n < 2] = np.nan
+        skew = (m3/n)/(m2/n)**1.5
+        skew[~(m2 > (np.finfo(np.float64).eps*mean)**2*n)] = np.nan
+
+        # fraction of days exceeding the mean flow
+        Tqmean = np.add.reduceat(Q > meanQ, starts, axis=1)/n
+        del meanQ
+
+        # change from the previous valid day of the same period
+        last = np.maximum.accumulate(np.where(valid, np.arange(Q.shape[1]), -1), axis=1)
+        prev = np.concatenate((np.full((Q.shape[0], 1), -1), last[:, :-1]), axis=1)
+        linked = valid & (prev >= starts[period])
+        change = np.where(linked, np.abs(Qz - np.take_along_axis(Qz, np.maximum(prev, 0), axis=1)), 0.0)
+        RBindex = np.add.reduceat(change, starts, axis=1)/total
+        RBindex[n == 0] = np.nan
+
+        # medians from the values sorted (NaN last) one period at a time
+        # for all stations
+        median = np.full(n.shape, np.nan)
+        for i in range(len(starts)):
+            block = np.sort(Q[:, edges[i]:edges[i+1]], axis=1)
+            lo = np.maximum(n[:, i] - 1, 0)//2
+            hi = n[:, i]//2
+            median[:, i] = (np.take_along_axis(block, lo[:, None], axis=1)[:, 0]
+                            + np.take_along_axis(block, np.minimum(hi, lengths[i] - 1)[:, None], axis=1)[:, 0])/2
+        median[n == 0] = np.nan
+        median3x = np.add.reduceat(Q > 3*np.repeat(median, lengths, axis=1), starts, axis=1).astype(np.float64)
+        median3x[n == 0] = np.nan
+
+    Metrics = {'Mean Flow': mean,
+               'Coeff Var': (std/mean)*100,
+               'Skew': skew,
+               'Tqmean': Tqmean,
+               'R-B Index': RBindex,
+               '3xMedian': median3x}
+
+    return( Metrics )
+
+@Instrument
+def GetAnnualStatistics(DataDF, periods=None, completeness=None, flag=False):
+    """This function calculates annual descriptive statistcs and metrics for
     the given streamflow time series.  Values are retuned as a dataframe of
     annual values for each water year.  Water year, as defined by the USGS,
-    starts on October 1."""
-    
-    # Seperate data into yearly data
-    DataDF['W_year']=DataDF.index.to_period('A-Sep')
-    DataDF['W_year']=DataDF['W_year']-1    
-    
+    starts on October 1.  periods is the PeriodIndex of DataDF, if already
+    computed.  With completeness (a fraction of days, e.g. 0.9), water years
+    with fewer valid days are skipped (their metrics are NaN), or with flag
+    marked in an "Incomplete" column, see CheckCompleteness."""
+
+    # Seperate data into water years, numbered by the calendar year in which
+    # they start, and offset from the first water year of the record
+    if periods is None:
+        periods = PeriodIndex(DataDF.index)
+    codes = periods.yearCodes
+    nYears = periods.nYears
+
     # Define the name of columns
     cols=['site_no','Mean Flow','Peak Flow','Median Flow','Coeff Var','Skew','Tqmean','R-B Index','7Q','3xMedian']
-   
-    # Create new dataframe
-    W_year = DataDF.resample('AS-OCT')
-    yearly_avg=W_year.mean()
-    WYDataDF=pd.DataFrame(0,index=yearly_avg.index, columns=cols)
-    GroupD=W_year
-    
-    #Calculate descriptive values 
-    WYDataDF['site_no']=GroupD['site_no'].min()
-    WYDataDF['Mean Flow']=GroupD['Discharge'].mean()
-    WYDataDF['Peak Flow']=GroupD['Discharge'].max()
-    WYDataDF['Median Flow']=GroupD['Discharge'].median()
-    WYDataDF['Coeff Var']=(GroupD['Discharge'].std()/GroupD['Discharge'].mean())*100
-    WYDataDF['Skew']=GroupD['Discharge'].apply(lambda x: stats.skew(x))
-    WYDataDF['Tqmean']=GroupD['Discharge'].apply(lambda x:CalcTqmean(x))
-    WYDataDF['R-B Index']=GroupD['Discharge'].apply(lambda x:CalcRBindex(x))
-    WYDataDF['7Q']=GroupD['Discharge'].apply(lambda x:Calc7Q(x))
-    WYDataDF['3xMedian']=GroupD['Discharge'].apply(lambda x:CalcExceed3TimesMedian(x))
+
+    # Create new dataframe indexed by the start date of each water year
+    WYDataDF=pd.DataFrame(0,index=periods.yearIndex, columns=cols)
+
+    #Calculate descriptive values in one pass over the record
+    WYDataDF['site_no']=DataDF['site_no'].groupby(codes).min().reindex(range(nYears)).values
+    Metrics = CalcGroupedMetrics(DataDF['Discharge'].values, codes, nYears)
+    for col in cols[1:]:
+        WYDataDF[col]=Metrics[col]
+    if completeness is not None:
+        WYDataDF = CheckCompleteness(WYDataDF, DataDF, 'Annual', completeness, flag)
     return ( WYDataDF )
 
-def GetMonthlyStatistics(DataDF):
+@Instrument
+def GetMonthlyStatistics(DataDF, periods=None, completeness=None, flag=False):
     """This function calculates monthly descriptive statistics and metrics 
     for the given streamflow time series.  Values are returned as a dataframe
-    of monthly values for each year."""
+    of monthly values for each year.  periods is the PeriodIndex of DataDF,
+    if already computed.  completeness and flag skip or flag incomplete
+    months as in GetAnnualStatistics."""
     
-    # Define the name of columns and create a new dataframe
+    # Define the name of columns
     cols=['site_no','Mean Flow','Coeff Var','Tqmean','R-B Index']
     
-    # Devide the dataset into monthly data
-    Mon_Data=DataDF.resample('MS').mean()
-    MoDataDF=pd.DataFrame(0,index=Mon_Data.index,columns=cols)
-    GroupD=DataDF.resample('MS')
+    # Devide the dataset into months, offset from the first month
+    if periods is None:
+        periods = PeriodIndex(DataDF.index)
+    codes = periods.monthCodes
+    nMonths = periods.nMonths
+
+    # Create new dataframe indexed by the start date of each month
+    MoDataDF=pd.DataFrame(0,index=periods.monthIndex,columns=cols)
     
-    #Calculate descriptive values
-    MoDataDF['site_no']=GroupD['site_no'].min()
-    MoDataDF['Mean Flow']=GroupD['Discharge'].mean()
-    MoDataDF['Coeff Var']=(GroupD['Discharge'].std()/GroupD['Discharge'].mean())*100
-    MoDataDF['Tqmean']=GroupD['Discharge'].apply(lambda x:CalcTqmean(x))
-    MoDataDF['R-B Index']=GroupD['Discharge'].apply(lambda x:CalcRBindex(x))
+    #Calculate descriptive values, only the metrics needed
+    MoDataDF['site_no']=DataDF['site_no'].groupby(codes).min().reindex(range(nMonths)).values
+    Metrics = CalcGroupedMetrics(DataDF['Discharge'].values, codes, nMonths, metrics=cols[1:])
+    for col in cols[1:]:
+        MoDataDF[col]=Metrics[col]
+    if completeness is not None:
+        MoDataDF = CheckCompleteness(MoDataDF, DataDF, 'Monthly', completeness, flag)
     return ( MoDataDF )
 
+def CheckCompleteness( Table, DataDF, period, completeness, flag=False ):
+    """This function skips or flags the periods of a table of statistics
+    (WYDataDF for period 'Annual', MoDataDF for 'Monthly') in which less
+    than the fraction completeness of the days have a value.  The
+    completeness of each period is taken from the summary made by ReadData
+    in DataDF.attrs['Quality'], or summarized with GetDataQuality if DataDF
+    has none.  Skipped periods keep their site_no but have NaN metrics;
+    with flag, the metrics are kept and an "Incomplete" column marks the
+    periods instead.  The routine returns the updated table."""
+
+    Quality = DataDF.attrs.get('Quality')
+    if Quality is None:
+        Quality = GetDataQuality(DataDF)
+    incomplete = Quality[period]['Completeness'].reindex(Table.index).fillna(0).values < completeness
+
+    if flag:
+        Table = Table.assign(Incomplete=incomplete)
+    else:
+        Table = Table.copy()
+        Table.loc[incomplete, Table.columns.drop('site_no')] = np.nan
+
+    return( Table )
+
+@Instrument
 def GetAnnualAverages(WYDataDF):
     """This function calculates annual average values for all statistics and
     metrics.  The routine returns an array of mean values for each metric
@@ -199,35 +1086,558 @@ def GetAnnualAverages(WYDataDF):
     
     return( AnnualAverages )
 
-def GetMonthlyAverages(MoDataDF):
+@Instrument
+def GetMonthlyAverages(MoDataDF, seasons=None):
     """This function calculates annual average monthly values for all 
     statistics and metrics.  The routine returns an array of mean values 
-    for each metric in the original dataframe."""
+    for each metric in the original dataframe.
+
+    Months are grouped by the calendar month of their date, so the record
+    may start in any month and have missing months.  seasons optionally
+    maps season names to lists of months (e.g. {'DJF': [12, 1, 2], ...}) to
+    average by season instead.  If MoDataDF has a "Station" column, as in
+    the combined tables of several stations, averages are calculated for
+    each station and month (or season) in the same grouping."""
     
-    # Define the name of columns and create a new dataframe
+    # Define the name of columns
     cols=['site_no','Mean Flow','Coeff Var','Tqmean','R-B Index']
-    m=[3,4,5,6,7,8,9,10,11,0,1,2]
-    index=0
-    
-    # Create a new dataframe
-    MonthlyAverages=pd.DataFrame(0,index=range(1,13),columns=cols)
-    
-    # Create the output table
-    for i in range(12):
-        MonthlyAverages.iloc[index,0]=MoDataDF['site_no'][::12].mean()
-        MonthlyAverages.iloc[index,1]=MoDataDF['Mean Flow'][m[index]::12].mean()
-        MonthlyAverages.iloc[index,2]=MoDataDF['Coeff Var'][m[index]::12].mean()
-        MonthlyAverages.iloc[index,3]=MoDataDF['Tqmean'][m[index]::12].mean()
-        MonthlyAverages.iloc[index,4]=MoDataDF['R-B Index'][m[index]::12].mean()
-        index+=1
+
+    # calendar month, or season, of every row
+    if seasons is None:
+        labels = list(range(1,13))
+        key = MoDataDF.index.month.values
+    else:
+        labels = list(seasons.keys())
+        codes = PeriodIndex(MoDataDF.index).SeasonCodes(seasons)
+        key = np.asarray(labels, dtype=object)[codes]
+        key[codes < 0] = np.nan
+
+    # Create the output table in one grouping
+    if 'Station' in MoDataDF.columns:
+        MonthlyAverages = MoDataDF[cols].groupby([MoDataDF['Station'].values, key]).mean()
+        MonthlyAverages = MonthlyAverages.reindex(pd.MultiIndex.from_product(
+            [MoDataDF['Station'].unique(), labels]))
+    else:
+        MonthlyAverages = MoDataDF[cols].groupby(key).mean().reindex(labels)
+
+    # keep integer site numbers when every group has one
+    if MonthlyAverages['site_no'].notna().all():
+        MonthlyAverages['site_no'] = MonthlyAverages['site_no'].astype(MoDataDF['site_no'].dtype)
     return( MonthlyAverages )
 
+@Instrument
+def WriteMetrics( Tables, fileName, sep=',', format='csv', append=False ):
+    """This function writes the metric tables of several stations to one
+    output in a single write.  Tables is either a dictionary of station
+    names and tables (DataFrames such as WYDataDF, or Series such as
+    AnnualAverages), which are tagged with a "Station" column and joined
+    with one concatenation, or an already combined DataFrame with a
+    "Station" column.  With format 'csv' the legacy layouts are written to
+    fileName with separator sep: tables one after another with a "Station"
+    column, and Series stacked with a "Station" entry after each station.
+    With format 'parquet' or 'feather' (which need the pyarrow package)
+    fileName is a directory with one partition per station, named
+    Station=<name>, so a single station can be read on its own.  With
+    append, the tables are added to an existing output (with the csv header
+    written only if the file is new) so a run can write its stations in
+    several parts."""
+
+    if format not in ['csv', 'parquet', 'feather']:
+        raise ValueError('unknown output format {}'.format(format))
+
+    # Series, stacked in the legacy layout or one row per station
+    if isinstance(Tables, dict) and isinstance(next(iter(Tables.values())), pd.Series):
+        if format == 'csv':
+            Output = pd.concat([pd.concat([Series, pd.Series({'Station': name})]) for name, Series in Tables.items()])
+            Output.to_csv(fileName, sep=sep, index=True, header=False, mode='a' if append else 'w')
+            return
+        Output = pd.DataFrame(Tables).T.rename_axis('Station').reset_index()
+
+    # one table with a Station column
+    elif isinstance(Tables, dict):
+        Output = pd.concat([Table.assign(Station=name) for name, Table in Tables.items()])
+    else:
+        Output = Tables
+    if format == 'csv':
+        Output.to_csv(fileName, sep=sep, index=True, mode='a' if append else 'w',
+                      header=not (append and os.path.exists(fileName)))
+        return
+
+    # columnar files partitioned by station
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('the {} output format requires the pyarrow package'.format(format))
+    if not isinstance(Output.index, pd.RangeIndex):
+        Output = Output.reset_index()
+    Output = Output.assign(Station=Output['Station'].astype(str))
+    if not append:
+        shutil.rmtree(fileName, ignore_errors=True)
+    if format == 'parquet':
+        Output.to_parquet(fileName, partition_cols=['Station'], index=False)
+    else:
+        os.makedirs(fileName, exist_ok=True)
+        for name, Part in Output.groupby('Station'):
+            Part.drop(columns='Station').reset_index(drop=True).to_feather(
+                os.path.join(fileName, 'Station={}.feather'.format(name)))
+
+def ListStations( source ):
+    """This function lists the stations of a batch run.  source is either a
+    directory, in which case every *_Discharge_*.txt file in it is a station
+    named by the text before "_Discharge", or a manifest file with one
+    station per line given as "name,path" or just "path" (blank lines and
+    lines starting with # are ignored, relative paths are relative to the
+    manifest).  The routine returns a dictionary of station names and
+    file paths in the order listed."""
+
+    Stations = {}
+    if os.path.isdir(source):
+        for path in sorted(glob.glob(os.path.join(source, '*_Discharge_*.txt'))):
+            Stations[os.path.basename(path).split('_Discharge')[0]] = path
+    else:
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                name, _, path = line.rpartition(',')
+                path = os.path.join(os.path.dirname(source), path.strip())
+                name = name.strip() or os.path.basename(path).split('_Discharge')[0]
+                Stations[name] = path
+
+    return( Stations )
+
+def ProcessStation( name, fileName, startDate, endDate, cacheDir=None,
+                    profile=False, completeness=None, flag=False, memory=False,
+                    cprofileFile=None, snapshotFile=None, quality=False ):
+    """This function runs ReadData, ClipData, GetAnnualStatistics,
+    GetMonthlyStatistics and the two averaging functions for one station.
+    It is the unit of work of RunBatch.  The routine returns a dictionary
+    of the station's tables, each tagged with a "Station" column.  With
+    quality, or with completeness, the annual and monthly data quality
+    summaries ("AnnualQuality" and "MonthlyQuality") are included.
+    completeness and flag are passed to the statistics functions.  With
+    profile, the stages are instrumented and their records are returned as
+    a "Profile" table as well; memory also traces their peak memory, and
+    the cProfile statistics and a tracemalloc snapshot of the station are
+    written to cprofileFile and snapshotFile if given."""
+
+    enable = profile and not Profile.enabled
+    if enable:
+        Profile.Enable(memory=memory, cprofile=cprofileFile is not None)
+
+    with Profile.Station(name):
+        DataDF, MissingValues = ReadData(fileName, cacheDir=cacheDir,
+                                         quality=quality or completeness is not None)
+        DataDF, MissingValues = ClipData(DataDF, startDate, endDate)
+        periods = PeriodIndex(DataDF.index)
+        WYDataDF = GetAnnualStatistics(DataDF, periods, completeness, flag)
+        MoDataDF = GetMonthlyStatistics(DataDF, periods, completeness, flag)
+
+        # averages as one row per station
+        AnnualAverages = GetAnnualAverages(WYDataDF).to_frame(name).T
+        MonthlyAverages = GetMonthlyAverages(MoDataDF)
+
+    Results = {'Annual': WYDataDF, 'Monthly': MoDataDF,
+               'AnnualAverages': AnnualAverages, 'MonthlyAverages': MonthlyAverages}
+    if 'Quality' in DataDF.attrs:
+        Results['AnnualQuality'] = DataDF.attrs['Quality']['Annual'].copy()
+        Results['MonthlyQuality'] = DataDF.attrs['Quality']['Monthly'].copy()
+    if profile:
+        Report = Profile.Report()
+        Results['Profile'] = Report[Report['Station'] == name].reset_index(drop=True)
+    if enable:
+        Profile.Disable()
+        Profile.WriteReport(None, profileFile=cprofileFile, snapshotFile=snapshotFile)
+    for table in Results.values():
+        table['Station'] = name
+    Results['AnnualAverages']['Missing Values'] = MissingValues
+
+    return( Results )
+
+def RunBatch( source, startDate, endDate, workers=None, cacheDir=None,
+              profile=False, completeness=None, flag=False, memory=False,
+              cprofileFile=None, snapshotFile=None, quality=False ):
+    """This function processes every station listed by ListStations(source)
+    with ProcessStation, spread over a pool of worker processes (workers
+    defaults to the number of CPUs, 1 runs in this process).  A station
+    that fails does not stop the batch.  The routine returns a dictionary
+    of combined tables ("Annual", "Monthly", "AnnualAverages" and
+    "MonthlyAverages", stations in listed order) and a dictionary of error
+    messages for the stations that failed.  With profile, a "Profile"
+    table of the per-station stage timings is included; memory,
+    cprofileFile and snapshotFile are as in ProcessStation, with the name
+    of each station added before the extension of the files.  quality,
+    completeness and flag are as in ProcessStation."""
+
+    Stations = ListStations(source)
+
+    def StationFile( fileName, name ):
+        # per-station name of a profiling output file
+        if fileName is None:
+            return( None )
+        root, ext = os.path.splitext(fileName)
+        return( '{}.{}{}'.format(root, name, ext) )
+
+    def Options( name ):
+        return( (cacheDir, profile, completeness, flag, memory,
+                 StationFile(cprofileFile, name), StationFile(snapshotFile, name), quality) )
+    Results = {}
+    Failures = {}
+
+    if workers == 1:
+        for name, path in Stations.items():
+            try:
+                Results[name] = ProcessStation(name, path, startDate, endDate, *Options(name))
+            except Exception:
+                Failures[name] = traceback.format_exc()
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(ProcessStation, name, path, startDate, endDate, *Options(name)): name
+                       for name, path in Stations.items()}
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    Results[name] = future.result()
+                except Exception:
+                    Failures[name] = traceback.format_exc()
+
+    # combine the tables of all stations in one copy each
+    done = [name for name in Stations if name in Results]
+    Combined = {}
+    if done:
+        for table in Results[done[0]].keys():
+            Combined[table] = pd.concat([Results[name][table] for name in done])
+
+    return( Combined, Failures )
+
+def BuildRegionalMatrix( Stations, startDate, endDate, matrixDir, cacheDir=None,
+                         dtype=np.float64 ):
+    """This function stores the daily discharge of many stations from
+    startDate to endDate as a memory-mapped matrix in matrixDir, with one
+    row per station (in the order of the Stations dictionary of names and
+    file paths) and one column per day.  Stations are read and clipped one
+    at a time with ReadData and ClipData and written into their row, so
+    only one station is held in memory.  Discharge.npy holds the flows (NaN
+    for NoData values and for dates absent from a file), Present.npy marks
+    the dates present in each file, and Stations.json the station names,
+    paths, site numbers, missing value counts and any failures.  A matrix
+    already built from the same files and dates is reused.  The routine
+    returns the two memory-mapped arrays and the station information."""
+
+    dates = pd.date_range(startDate, endDate, freq='D', name='Date')
+    Info = {'stations': list(Stations.keys()), 'paths': list(Stations.values()),
+            'mtimes': [os.path.getmtime(path) if os.path.exists(path) else None for path in Stations.values()],
+            'start': str(dates[0].date()), 'end': str(dates[-1].date()), 'dtype': np.dtype(dtype).str}
+    infoFile = os.path.join(matrixDir, 'Stations.json')
+
+    # reuse the matrix if nothing changed
+    if os.path.exists(infoFile):
+        with open(infoFile) as f:
+            Saved = json.load(f)
+        if all(Saved.get(key) == value for key, value in Info.items()):
+            Q = np.load(os.path.join(matrixDir, 'Discharge.npy'), mmap_mode='r')
+            Present = np.load(os.path.join(matrixDir, 'Present.npy'), mmap_mode='r')
+            return( Q, Present, Saved )
+
+    # fill the rows one station at a time
+    os.makedirs(matrixDir, exist_ok=True)
+    Q = np.lib.format.open_memmap(os.path.join(matrixDir, 'Discharge.npy'), mode='w+',
+                                  dtype=dtype, shape=(len(Stations), len(dates)))
+    Present = np.lib.format.open_memmap(os.path.join(matrixDir, 'Present.npy'), mode='w+',
+                                        dtype=np.bool_, shape=(len(Stations), len(dates)))
+    Info.update({'site_no': [], 'missing': [], 'failures': {}})
+    first = dates.values[0].astype('datetime64[D]')
+    for row, (name, path) in enumerate(Stations.items()):
+        Q[row] = np.nan
+        Present[row] = False
+        try:
+            DataDF, MissingValues = ReadData(path, cacheDir=cacheDir)
+            DataDF, MissingValues = ClipData(DataDF, startDate, endDate)
+            if len(DataDF) == 0:
+                raise ValueError('no data from {} to {}'.format(Info['start'], Info['end']))
+            columns = (DataDF.index.values.astype('datetime64[D]') - first).astype(np.int64)
+            Q[row, columns] = DataDF['Discharge'].values
+            Present[row, columns] = True
+            Info['site_no'].append(int(DataDF['site_no'].iloc[0]))
+            Info['missing'].append(int(MissingValues))
+        except Exception:
+            Info['site_no'].append(None)
+            Info['missing'].append(None)
+            Info['failures'][name] = traceback.format_exc()
+    Q.flush()
+    Present.flush()
+
+    # the station information is written last, so an interrupted build is
+    # not reused
+    with open(infoFile, 'w') as f:
+        json.dump(Info, f)
+
+    return( Q, Present, Info )
+
+def RunRegional( source, startDate, endDate, outDir, matrixDir=None, memory=256*2**20,
+                 cacheDir=None, dtype=np.float64, format='csv' ):
+    """This function is an out-of-core version of RunBatch for very many
+    stations.  The stations listed by ListStations(source) are stored in a
+    memory-mapped matrix with BuildRegionalMatrix (in matrixDir, by default
+    outDir/matrix), and the annual and monthly statistics and averages are
+    then computed a tile of stations at a time and appended to the output
+    files in outDir as each tile is done (with WriteMetrics, in the same
+    layouts as the batch mode).  The number of stations in a tile is chosen
+    so that a tile and its intermediates take about memory bytes, so the
+    memory used does not grow with the number of stations.  As in the
+    batch mode, each station gets a row for each water year and month from
+    the first to the last date of its clipped record.  The routine returns
+    a dictionary of error messages for the stations that failed."""
+
+    if matrixDir is None:
+        matrixDir = os.path.join(outDir, 'matrix')
+    Q, Present, Info = BuildRegionalMatrix(ListStations(source), startDate, endDate,
+                                           matrixDir, cacheDir, dtype)
+    dates = pd.date_range(Info['start'], Info['end'], freq='D', name='Date')
+    periods = PeriodIndex(dates)
+    good = np.array([name not in Info['failures'] and site is not None
+                     for name, site in zip(Info['stations'], Info['site_no'])], dtype=bool)
+
+    # stations per tile, allowing for the intermediates of MetricGraph
+    tile = max(1, int(memory//(len(dates)*160)))
+
+    os.makedirs(outDir, exist_ok=True)
+    Outputs = {'Annual': ('Annual_Metrics', ','), 'Monthly': ('Monthly_Metrics', ','),
+               'AnnualAverages': ('Average_Annual_Metrics', '\t'),
+               'MonthlyAverages': ('Average_Monthly_Metrics', '\t')}
+    written = False
+    for first in range(0, len(Q), tile):
+
+        rows = np.flatnonzero(good[first:first + tile]) + first
+        if len(rows) == 0:
+            continue
+        names = np.asarray(Info['stations'], dtype=object)[rows]
+        sites = np.array([Info['site_no'][row] for row in rows], dtype=np.int64)
+        Tile = np.asarray(Q[rows], dtype=np.float64).ravel()
+        present = np.asarray(Present[rows])
+
+        # first and last date of each station's record
+        firstDay = np.argmax(present, axis=1)
+        lastDay = present.shape[1] - 1 - np.argmax(present[:, ::-1], axis=1)
+        present = present.ravel()
+        Tables = {}
+
+        # statistics of every station and period of the tile in one pass,
+        # leaving out the dates absent from the files
+        for table, nPeriods, dayCodes, index, cols in [
+                ('Annual', periods.nYears, periods.yearCodes, periods.yearIndex, MetricGraph.Metrics),
+                ('Monthly', periods.nMonths, periods.monthCodes, periods.monthIndex,
+                 ['Mean Flow', 'Coeff Var', 'Tqmean', 'R-B Index'])]:
+            nGroups = len(rows)*nPeriods
+            codes = ((np.arange(len(rows))*nPeriods)[:, None] + dayCodes[None, :]).ravel()[present]
+            Metrics = CalcGroupedMetrics(Tile[present], codes, nGroups, metrics=cols)
+
+            # keep the periods from the first to the last date of each
+            # record, as GetAnnualStatistics does, with site_no only for
+            # periods with dates in the file
+            period = np.arange(nPeriods)[None, :]
+            keep = ((period >= dayCodes[firstDay][:, None]) & (period <= dayCodes[lastDay][:, None])).ravel()
+            site_no = np.repeat(sites, nPeriods)
+            days = np.bincount(codes, minlength=nGroups)
+            if (days[keep] == 0).any():
+                site_no = np.where(days > 0, site_no, np.nan)
+
+            Table = pd.DataFrame({'site_no': site_no[keep]}, index=np.tile(index, len(rows))[keep])
+            for col in cols:
+                Table[col] = Metrics[col][keep]
+            Table.index.name = index.name
+            Table['Station'] = np.repeat(names, nPeriods)[keep]
+            Tables[table] = Table
+            del codes, Metrics
+        del Tile, present
+
+        # averages of each station
+        Annual = Tables['Annual']
+        AnnualAverages = Annual.drop(columns='Station').groupby(Annual['Station'].values, sort=False).mean()
+        AnnualAverages['Station'] = AnnualAverages.index
+        AnnualAverages['Missing Values'] = [Info['missing'][row] for row in rows]
+        MonthlyAverages = GetMonthlyAverages(Tables['Monthly'])
+        MonthlyAverages['Station'] = MonthlyAverages.index.get_level_values(0)
+        MonthlyAverages.index = MonthlyAverages.index.get_level_values(1)
+        Tables.update({'AnnualAverages': AnnualAverages, 'MonthlyAverages': MonthlyAverages})
+
+        # write the tile
+        for table, (name, sep) in Outputs.items():
+            if format == 'csv':
+                name += '.csv' if sep == ',' else '.txt'
+            WriteMetrics(Tables[table], os.path.join(outDir, name), sep=sep, format=format, append=written)
+        written = True
+
+    return( Info['failures'] )
+
+@Instrument
+def UpdateStatistics( DataDF, stateFile ):
+    """This function is an incremental version of GetAnnualStatistics,
+    GetMonthlyStatistics, GetAnnualAverages and GetMonthlyAverages.  The
+    daily values, tables and running sums of the previous call are kept in
+    stateFile.  Days that were added, removed, or revised in value or
+    qualification code (e.g. "P" values approved as "A") since then are
+    found, only the water years and months containing them are recomputed,
+    and the averages are updated by replacing those periods in the running
+    sums.  Without a stateFile everything is computed and the state is
+    created.  The routine returns WYDataDF, MoDataDF, AnnualAverages and
+    MonthlyAverages."""
+
+    Daily = DataDF[['Discharge', 'Quality']]
+
+    if not os.path.exists(stateFile):
+
+        # first run, compute all periods
+        periods = PeriodIndex(DataDF.index)
+        WYDataDF = GetAnnualStatistics(DataDF, periods)
+        MoDataDF = GetMonthlyStatistics(DataDF, periods)
+        State = {'Daily': Daily.copy(), 'WYDataDF': WYDataDF, 'MoDataDF': MoDataDF,
+                 'AnnualSums': WYDataDF.sum(), 'AnnualCounts': WYDataDF.count(),
+                 'MonthlySums': MoDataDF.groupby(MoDataDF.index.month).sum(),
+                 'MonthlyCounts': MoDataDF.groupby(MoDataDF.index.month).count()}
+
+    else:
+        State = pd.read_pickle(stateFile)
+
+        # find the days that were added, removed or revised
+        dates = State['Daily'].index.union(Daily.index)
+        Old = State['Daily'].reindex(dates)
+        New = Daily.reindex(dates)
+        same = ((Old['Discharge'] == New['Discharge']) | (Old['Discharge'].isna() & New['Discharge'].isna())) \
+            & (Old['Quality'].fillna('') == New['Quality'].fillna('')) \
+            & dates.isin(State['Daily'].index) & dates.isin(Daily.index)
+        dates = dates[~same.values]
+
+        # water years and months touched by the changes
+        years = np.unique(dates.year + (dates.month >= 10) - 1)
+        yearIdx = pd.DatetimeIndex([pd.Timestamp(y, 10, 1) for y in years], name='Date')
+        monthIdx = pd.DatetimeIndex(np.unique(dates.values.astype('datetime64[M]')), name='Date')
+
+        # recompute the statistics of those periods only
+        periods = PeriodIndex(DataDF.index)
+        inYears = np.isin(periods.firstYear + periods.yearCodes, years)
+        Subset = DataDF.loc[inYears]
+        NewWY = State['WYDataDF'].iloc[:0]
+        NewMo = State['MoDataDF'].iloc[:0]
+        if len(Subset) > 0:
+            periods = PeriodIndex(Subset.index)
+            NewWY = GetAnnualStatistics(Subset, periods)
+            NewWY = NewWY.loc[NewWY.index.intersection(yearIdx)]
+            NewMo = GetMonthlyStatistics(Subset, periods)
+            NewMo = NewMo.loc[NewMo.index.intersection(monthIdx)]
+
+            # the unchanged periods between the changed ones have no days in
+            # Subset, so cast the kept rows back to the types of the tables
+            NewWY = NewWY.astype({col: dtype for col, dtype in State['WYDataDF'].dtypes.items()
+                                  if NewWY[col].notna().all()})
+            NewMo = NewMo.astype({col: dtype for col, dtype in State['MoDataDF'].dtypes.items()
+                                  if NewMo[col].notna().all()})
+        OldWY = State['WYDataDF'].loc[State['WYDataDF'].index.intersection(yearIdx)]
+        OldMo = State['MoDataDF'].loc[State['MoDataDF'].index.intersection(monthIdx)]
+
+        # swap the recomputed periods into the tables and running sums
+        WYDataDF = pd.concat([State['WYDataDF'].drop(OldWY.index), NewWY]).sort_index()
+        MoDataDF = pd.concat([State['MoDataDF'].drop(OldMo.index), NewMo]).sort_index()
+        State['AnnualSums'] = State['AnnualSums'] - OldWY.sum() + NewWY.sum()
+        State['AnnualCounts'] = State['AnnualCounts'] - OldWY.count() + NewWY.count()
+        State['MonthlySums'] = State['MonthlySums'] \
+            .sub(OldMo.groupby(OldMo.index.month).sum(), fill_value=0) \
+            .add(NewMo.groupby(NewMo.index.month).sum(), fill_value=0)
+        State['MonthlyCounts'] = State['MonthlyCounts'] \
+            .sub(OldMo.groupby(OldMo.index.month).count(), fill_value=0) \
+            .add(NewMo.groupby(NewMo.index.month).count(), fill_value=0)
+        State.update({'Daily': Daily.copy(), 'WYDataDF': WYDataDF, 'MoDataDF': MoDataDF})
+
+    # store the state for the next update
+    os.makedirs(os.path.dirname(os.path.abspath(stateFile)), exist_ok=True)
+    pd.to_pickle(State, stateFile)
+
+    # averages from the running sums
+    AnnualAverages = (State['AnnualSums']/State['AnnualCounts']).astype(np.float64)
+    MonthlyAverages = (State['MonthlySums']/State['MonthlyCounts']).reindex(range(1,13))
+    MonthlyAverages.index.name = None
+    if MonthlyAverages['site_no'].notna().all():
+        MonthlyAverages['site_no'] = MonthlyAverages['site_no'].astype(MoDataDF['site_no'].dtype)
+
+    return( WYDataDF, MoDataDF, AnnualAverages, MonthlyAverages )
+
 # the following condition checks whether we are running as a script, in which 
 # case run the test code, otherwise functions are being imported so do not.
 # put the main routines from your code after this conditional check.
 
 if __name__ == '__main__':
 
+    # with a --batch source, process a directory or manifest of stations in
+    # parallel instead of the two stations of the assignment
+    parser = argparse.ArgumentParser(description='Streamflow statistics and metrics.')
+    parser.add_argument('--batch', help='directory of *_Discharge_*.txt files or manifest of stations')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--regional', action='store_true',
+                        help='out-of-core batch mode: memory-mapped discharge matrix, processed in tiles of stations')
+    parser.add_argument('--tile-memory', type=int, default=256, help='memory in MB for a tile of the regional mode')
+    parser.add_argument('--start', default='1969-10-01', help='first date of the analysis period')
+    parser.add_argument('--end', default='2019-09-30', help='last date of the analysis period')
+    parser.add_argument('--outdir', default='.', help='directory for the batch output files')
+    parser.add_argument('--state', help='directory of state files for incremental updates')
+    parser.add_argument('--profile', help='JSON file for a report of the time, calls, rows and memory of each stage')
+    parser.add_argument('--cprofile', help='file for cProfile statistics of the run (with --profile)')
+    parser.add_argument('--tracemalloc', action='store_true', help='trace peak memory of each stage (with --profile)')
+    parser.add_argument('--snapshot', help='file for a tracemalloc snapshot at the end of the run (with --tracemalloc)')
+    parser.add_argument('--completeness', type=float, default=None,
+                        help='skip water years and months with a smaller fraction of days with values')
+    parser.add_argument('--flag-incomplete', action='store_true',
+                        help='with --completeness, flag incomplete periods in an "Incomplete" column instead')
+    parser.add_argument('--quality', action='store_true', help='also write the annual and monthly data quality tables')
+    parser.add_argument('--format', default='csv', choices=['csv', 'parquet', 'feather'],
+                        help='output format, csv/tsv files or columnar files partitioned by station')
+    args = parser.parse_args()
+    if args.regional:
+        unsupported = [option for option, value in [('--completeness', args.completeness is not None),
+                                                    ('--flag-incomplete', args.flag_incomplete),
+                                                    ('--quality', args.quality), ('--profile', args.profile),
+                                                    ('--state', args.state)] if value]
+        if not args.batch:
+            parser.error('--regional requires --batch')
+        if unsupported:
+            parser.error('--regional does not support {}'.format(', '.join(unsupported)))
+    if args.batch and args.state:
+        parser.error('--batch does not support --state')
+    if args.state:
+        unsupported = [option for option, value in [('--completeness', args.completeness is not None),
+                                                    ('--flag-incomplete', args.flag_incomplete)] if value]
+        if unsupported:
+            parser.error('--state does not support {}'.format(', '.join(unsupported)))
+
+    if args.batch and args.regional:
+        Failures = RunRegional(args.batch, args.start, args.end, args.outdir,
+                               memory=args.tile_memory*2**20, cacheDir='.rdb_cache', format=args.format)
+        for name, error in Failures.items():
+            print("-"*50, "\n\nFailed station {}...\n\n".format(name), error)
+        sys.exit(1 if Failures else 0)
+
+    if args.batch:
+        Combined, Failures = RunBatch(args.batch, args.start, args.end, workers=args.workers,
+                                      cacheDir='.rdb_cache', profile=bool(args.profile),
+                                      completeness=args.completeness, flag=args.flag_incomplete,
+                                      memory=args.tracemalloc, cprofileFile=args.cprofile,
+                                      snapshotFile=args.snapshot, quality=args.quality)
+        if args.profile and 'Profile' in Combined:
+            Combined.pop('Profile').to_json(args.profile, orient='records', indent=2)
+        os.makedirs(args.outdir, exist_ok=True)
+        for table, name, sep in [('Annual', 'Annual_Metrics', ','), ('Monthly', 'Monthly_Metrics', ','),
+                                 ('AnnualAverages', 'Average_Annual_Metrics', '\t'),
+                                 ('MonthlyAverages', 'Average_Monthly_Metrics', '\t'),
+                                 ('AnnualQuality', 'Annual_Quality', ','), ('MonthlyQuality', 'Monthly_Quality', ',')]:
+            if table in Combined and (args.quality or 'Quality' not in table):
+                if args.format == 'csv':
+                    name += '.csv' if sep == ',' else '.txt'
+                WriteMetrics(Combined[table], os.path.join(args.outdir, name), sep=sep, format=args.format)
+        print("Processed {} stations, {} failed".format(len(Combined.get('AnnualAverages', [])), len(Failures)))
+        for name, error in Failures.items():
+            print("-"*50, "\n\nFailed station {}...\n\n".format(name), error)
+        sys.exit(1 if Failures else 0)
+
     # define filenames as a dictionary
     # NOTE - you could include more than jsut the filename in a dictionary, 
     #  such as full name of the river or gaging site, units, etc. that would
@@ -243,62 +1653,67 @@ if __name__ == '__main__':
     AnnualAverages = {}
     MonthlyAverages = {}
     
+    # record the time, calls, rows and memory of each stage when asked to
+    if args.profile:
+        Profile.Enable(memory=args.tracemalloc, cprofile=args.cprofile is not None)
+
     # process input datasets
     for file in fileName.keys():
-        
-        print( "\n", "="*50, "\n  Working on {} \n".format(file), "="*50, "\n" )
-        
-        DataDF[file], MissingValues[file] = ReadData(fileName[file])
-        print( "-"*50, "\n\nRaw data for {}...\n\n".format(file), DataDF[file].describe(), "\n\nMissing values: {}\n\n".format(MissingValues[file]))
-        
-        # clip to consistent period
-        DataDF[file], MissingValues[file] = ClipData( DataDF[file], '1969-10-01', '2019-09-30' )
-        print( "-"*50, "\n\nSelected period data for {}...\n\n".format(file), DataDF[file].describe(), "\n\nMissing values: {}\n\n".format(MissingValues[file]))
-        
-        # calculate descriptive statistics for each water year
-        WYDataDF[file] = GetAnnualStatistics(DataDF[file])
-        
-        # calcualte the annual average for each stistic or metric
-        AnnualAverages[file] = GetAnnualAverages(WYDataDF[file])
-        
-        print("-"*50, "\n\nSummary of water year metrics...\n\n", WYDataDF[file].describe(), "\n\nAnnual water year averages...\n\n", AnnualAverages[file])
-
-        # calculate descriptive statistics for each month
-        MoDataDF[file] = GetMonthlyStatistics(DataDF[file])
-
-        # calculate the annual averages for each statistics on a monthly basis
-        MonthlyAverages[file] = GetMonthlyAverages(MoDataDF[file])
-        
-        print("-"*50, "\n\nSummary of monthly metrics...\n\n", MoDataDF[file].describe(), "\n\nAnnual Monthly Averages...\n\n", MonthlyAverages[file])
-    
-    # Write data into annual metrics csv file
-    Wc = WYDataDF['Wildcat']
-    Wc['Station'] = 'Wildcat'
-    Tip = WYDataDF['Tippe']
-    Tip['Station'] = 'Tippe'
-    Wc = Wc.append(Tip)
-    Wc.to_csv('Annual_Metrics.csv',sep=',', index=True)
-        
-    # Write data into monthly metrics csv file
-    Wc_m = MoDataDF['Wildcat']
-    Wc_m['Station'] = 'Wildcat'
-    Tip_m = MoDataDF['Tippe']
-    Tip_m['Station'] = 'Tippe'
-    Wc_m = Wc_m.append(Tip_m)
-    Wc_m.to_csv('Monthly_Metrics.csv',sep=',', index=True)
-    
-    # Write data into average annual metrics text file
-    Wc_avg = AnnualAverages['Wildcat']
-    Wc_avg['Station'] = 'Wildcat'
-    Tip_avg = AnnualAverages['Tippe']
-    Tip_avg['Station'] = 'Tippe'
-    Wc_avg = Wc_avg.append(Tip_avg)
-    Wc_avg.to_csv('Average_Annual_Metrics.txt',sep='\t', index=True)
-        
-    # Write data into average monthly metrics text file
-    Wc_avg_m = MonthlyAverages['Wildcat']
-    Wc_avg_m['Station'] = 'Wildcat'
-    Tip_avg_m = MonthlyAverages['Tippe']
-    Tip_avg_m['Station'] = 'Tippe'
-    Wc_avg_m = Wc_avg_m.append(Tip_avg_m)
-    Wc_avg_m.to_csv('Average_Monthly_Metrics.txt',sep='\t', index=True)
\ No newline at end of file
+        with Profile.Station(file):
+
+            print( "\n", "="*50, "\n  Working on {} \n".format(file), "="*50, "\n" )
+
+            DataDF[file], MissingValues[file] = ReadData(fileName[file], cacheDir='.rdb_cache',
+                                                         quality=args.quality or args.completeness is not None)
+            print( "-"*50, "\n\nRaw data for {}...\n\n".format(file), DataDF[file].describe(), "\n\nMissing values: {}\n\n".format(MissingValues[file]))
+
+            # clip to consistent period
+            DataDF[file], MissingValues[file] = ClipData( DataDF[file], '1969-10-01', '2019-09-30' )
+            print( "-"*50, "\n\nSelected period data for {}...\n\n".format(file), DataDF[file].describe(), "\n\nMissing values: {}\n\n".format(MissingValues[file]))
+
+            if args.state:
+                # recompute only the water years and months that changed since
+                # the last run
+                WYDataDF[file], MoDataDF[file], AnnualAverages[file], MonthlyAverages[file] = \
+                    UpdateStatistics(DataDF[file], os.path.join(args.state, file + '.pkl'))
+            else:
+                # water year and month of every day, shared by the statistics
+                periods = PeriodIndex(DataDF[file].index)
+
+                # calculate descriptive statistics for each water year
+                WYDataDF[file] = GetAnnualStatistics(DataDF[file], periods, args.completeness, args.flag_incomplete)
+
+                # calcualte the annual average for each stistic or metric
+                AnnualAverages[file] = GetAnnualAverages(WYDataDF[file])
+
+                # calculate descriptive statistics for each month
+                MoDataDF[file] = GetMonthlyStatistics(DataDF[file], periods, args.completeness, args.flag_incomplete)
+
+                # calculate the annual averages for each statistics on a monthly basis
+                MonthlyAverages[file] = GetMonthlyAverages(MoDataDF[file])
+
+            print("-"*50, "\n\nSummary of water year metrics...\n\n", WYDataDF[file].describe(), "\n\nAnnual water year averages...\n\n", AnnualAverages[file])
+
+            print("-"*50, "\n\nSummary of monthly metrics...\n\n", MoDataDF[file].describe(), "\n\nAnnual Monthly Averages...\n\n", MonthlyAverages[file])
+
+    # Write data into the annual and monthly metrics csv files and the
+    # average annual and monthly metrics text files, or into directories
+    # partitioned by station for the columnar formats
+    for Tables, name, sep in [(WYDataDF, 'Annual_Metrics', ','), (MoDataDF, 'Monthly_Metrics', ','),
+                              (AnnualAverages, 'Average_Annual_Metrics', '\t'),
+                              (MonthlyAverages, 'Average_Monthly_Metrics', '\t')]:
+        if args.format == 'csv':
+            name += '.csv' if sep == ',' else '.txt'
+        WriteMetrics(Tables, name, sep=sep, format=args.format)
+
+    # Write the completeness, gaps and quality codes of each period
+    if args.quality:
+        for period in ['Annual', 'Monthly']:
+            name = period + '_Quality' + ('.csv' if args.format == 'csv' else '')
+            WriteMetrics({file: DataDF[file].attrs['Quality'][period] for file in DataDF.keys()},
+                         name, format=args.format)
+
+    # write the profile of the run
+    if args.profile:
+        Profile.Disable()
+        Profile.WriteReport(args.profile, profileFile=args.cprofile, snapshotFile=args.snapshot)
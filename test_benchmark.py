@@ -0,0 +1,23 @@
+#!/bin/env python
+#
+# Tests of the synthetic records written by benchmark.py, run with
+#
+#   python -m pytest test_benchmark.py
+#
+#
+import pytest
+
+import benchmark
+import program_10 as p10
+
+def test_synthetic_record_500_years(tmp_path):
+    # the longest records of the benchmark fit the pandas timestamps
+    fileName = str(tmp_path/'Synthetic_Discharge_500y.txt')
+    rows = benchmark.MakeSyntheticRecord(fileName, 500)
+    DataDF, MissingValues = p10.ReadData(fileName)
+    assert len(DataDF) == rows
+    assert DataDF.index.min().year == 1700 and DataDF.index.max().year == 2200
+
+def test_synthetic_record_past_timestamps(tmp_path):
+    with pytest.raises(ValueError):
+        benchmark.MakeSyntheticRecord(str(tmp_path/'Synthetic_Discharge_600y.txt'), 600)
@@ -0,0 +1,48 @@
+#!/bin/env python
+#
+# Offline tests of ingest.py against the local stub server, run with
+#
+#   python -m pytest test_ingest.py
+#
+#
+import os
+import pandas as pd
+
+import ingest
+import program_10 as p10
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def test_fetch_retry_and_missing_site():
+    # one 503 for Wildcat, retried, and a site the server does not have
+    server, base = ingest.StartStubServer(failures={"03335000": 1})
+    try:
+        urls = {"Wildcat": ingest.NwisUrl("03335000", base=base),
+                "Tippe": ingest.NwisUrl("03331500", base=base),
+                "Missing": ingest.NwisUrl("00000000", base=base)}
+        Data, Failures = ingest.IngestSites(urls, concurrency=2, backoff=0.05)
+    finally:
+        server.shutdown()
+
+    assert sorted(Data.keys()) == ["Tippe", "Wildcat"]
+    assert server.failures["03335000"] == 0
+    assert list(Failures.keys()) == ["Missing"] and "404" in Failures["Missing"]
+
+    # the fetched frames are the frames read from the files
+    for name, site in [("Wildcat", "03335000"), ("Tippe", "03331500")]:
+        DataDF, MissingValues = p10.ReadData(os.path.join(here, ingest.GaugeFiles[site]))
+        pd.testing.assert_frame_equal(Data[name][0], DataDF)
+        assert Data[name][1] == MissingValues
+
+def test_stalled_request_times_out():
+    # the first request stalls past the timeout; with a retry the second
+    # request is served, without one the site fails
+    server, base = ingest.StartStubServer(stalls={"03331500": 2}, stallTime=2.0)
+    try:
+        urls = {"Tippe": ingest.NwisUrl("03331500", base=base)}
+        Data, Failures = ingest.IngestSites(urls, retries=0, backoff=0.05, timeout=0.5)
+        assert Data == {} and Failures["Tippe"].startswith("TimeoutError")
+        Data, Failures = ingest.IngestSites(urls, retries=1, backoff=0.05, timeout=0.5)
+        assert list(Data.keys()) == ["Tippe"] and Failures == {}
+    finally:
+        server.shutdown()
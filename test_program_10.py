@@ -0,0 +1,70 @@
+#!/bin/env python
+#
+# Tests of the vectorized annual and monthly statistics of program_10.py
+# against the per-period Calc* functions applied to every water year and
+# month, as the original GetAnnualStatistics and GetMonthlyStatistics did,
+# run with
+#
+#   python -m pytest test_program_10.py
+#
+#
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.stats as stats
+
+import program_10 as p10
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+def AppliedAnnualStatistics( DataDF ):
+    # the original GetAnnualStatistics, one apply per metric
+    cols = ['site_no','Mean Flow','Peak Flow','Median Flow','Coeff Var','Skew','Tqmean','R-B Index','7Q','3xMedian']
+    GroupD = DataDF[['site_no', 'Discharge']].resample('AS-OCT')
+    WYDataDF = pd.DataFrame(0, index=GroupD.mean().index, columns=cols)
+    WYDataDF['site_no'] = GroupD['site_no'].min()
+    WYDataDF['Mean Flow'] = GroupD['Discharge'].mean()
+    WYDataDF['Peak Flow'] = GroupD['Discharge'].max()
+    WYDataDF['Median Flow'] = GroupD['Discharge'].median()
+    WYDataDF['Coeff Var'] = (GroupD['Discharge'].std()/GroupD['Discharge'].mean())*100
+    WYDataDF['Skew'] = GroupD['Discharge'].apply(lambda x: stats.skew(x))
+    WYDataDF['Tqmean'] = GroupD['Discharge'].apply(p10.CalcTqmean)
+    WYDataDF['R-B Index'] = GroupD['Discharge'].apply(p10.CalcRBindex)
+    WYDataDF['7Q'] = GroupD['Discharge'].apply(p10.Calc7Q)
+    WYDataDF['3xMedian'] = GroupD['Discharge'].apply(p10.CalcExceed3TimesMedian)
+    return( WYDataDF )
+
+def AppliedMonthlyStatistics( DataDF ):
+    # the original GetMonthlyStatistics, one apply per metric
+    cols = ['site_no','Mean Flow','Coeff Var','Tqmean','R-B Index']
+    GroupD = DataDF[['site_no', 'Discharge']].resample('MS')
+    MoDataDF = pd.DataFrame(0, index=GroupD.mean().index, columns=cols)
+    MoDataDF['site_no'] = GroupD['site_no'].min()
+    MoDataDF['Mean Flow'] = GroupD['Discharge'].mean()
+    MoDataDF['Coeff Var'] = (GroupD['Discharge'].std()/GroupD['Discharge'].mean())*100
+    MoDataDF['Tqmean'] = GroupD['Discharge'].apply(p10.CalcTqmean)
+    MoDataDF['R-B Index'] = GroupD['Discharge'].apply(p10.CalcRBindex)
+    return( MoDataDF )
+
+def Records():
+    # both gauges, whole and clipped to the assignment period, and Wildcat
+    # Creek with an all-NaN water year (1980) and a missing one (1990)
+    for name, fileName in [("Wildcat", "WildcatCreek_Discharge_03335000_19540601-20200315.txt"),
+                           ("Tippe", "TippecanoeRiver_Discharge_03331500_19431001-20200315.txt")]:
+        DataDF, MissingValues = p10.ReadData(os.path.join(here, fileName))
+        yield name, DataDF
+        yield name + " clipped", p10.ClipData(DataDF, '1969-10-01', '2019-09-30')[0]
+        if name == "Wildcat":
+            DataDF = DataDF.copy()
+            DataDF.loc['1980-10-01':'1981-09-30', 'Discharge'] = np.nan
+            DataDF = DataDF.drop(DataDF.loc['1990-10-01':'1991-09-30'].index)
+            yield name + " gaps", DataDF
+
+@pytest.mark.filterwarnings('ignore::RuntimeWarning')
+@pytest.mark.parametrize('name, DataDF', list(Records()), ids=lambda value: value if isinstance(value, str) else '')
+def test_statistics_match_applied_calc_functions(name, DataDF):
+    pd.testing.assert_frame_equal(p10.GetAnnualStatistics(DataDF), AppliedAnnualStatistics(DataDF),
+                                  check_freq=False, rtol=1e-9)
+    pd.testing.assert_frame_equal(p10.GetMonthlyStatistics(DataDF), AppliedMonthlyStatistics(DataDF),
+                                  check_freq=False, rtol=1e-9)
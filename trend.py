@@ -0,0 +1,227 @@
+#!/bin/env python
+#
+# This module tests the annual (or monthly) metric series built by
+# program_10.py for trends and change points: the Mann-Kendall trend test,
+# Sen's slope and the Pettitt change-point test.  Every column of a table
+# such as WYDataDF, or of the combined table of many stations, is tested at
+# once with array operations along the time axis, in O(n log n) time per
+# series for the Mann-Kendall and Pettitt statistics.  Significance can
+# optionally be estimated with a moving block bootstrap, which keeps the
+# serial correlation of the series.
+#
+#
+import pandas as pd
+import scipy.stats as stats
+import numpy as np
+
+def RankColumns( X ):
+    """This function ranks the values of each column of the 2-D array X,
+    with NaN values ranked last.  The routine returns the dense ranks
+    (1, 2, ... with tied values sharing a rank), the average ranks (1 to n,
+    tied values sharing the mean of their ranks) and the tie correction
+    sum of t(t-1)(2t+5) over the groups of t tied values of each column."""
+
+    n, m = X.shape
+    order = np.argsort(X, axis=0, kind='stable')
+    S = np.take_along_axis(X, order, axis=0)
+    position = np.arange(n)[:, None]
+
+    # runs of equal values in the sorted columns (NaN never equals NaN)
+    first = np.ones((n, m), dtype=bool)
+    first[1:] = S[1:] != S[:-1]
+    last = np.ones((n, m), dtype=bool)
+    last[:-1] = first[1:]
+    start = np.maximum.accumulate(np.where(first, position, 0), axis=0)
+    end = n - 1 - np.maximum.accumulate(np.where(last[::-1], position, 0), axis=0)[::-1]
+    t = end - start + 1
+
+    dense = np.empty((n, m), dtype=np.int64)
+    average = np.empty((n, m), dtype=np.float64)
+    np.put_along_axis(dense, order, np.cumsum(first, axis=0), axis=0)
+    np.put_along_axis(average, order, (start + end)/2 + 1, axis=0)
+    ties = np.where(first & ~np.isnan(S), t*(t - 1)*(2*t + 5), 0).sum(axis=0)
+
+    return( dense, average, ties )
+
+def KendallS( X ):
+    """This function computes the Mann-Kendall statistic S, the number of
+    later values greater than an earlier value minus the number smaller,
+    of each column of the 2-D array X, ignoring NaN values.  Ranks are
+    counted with one Fenwick tree per column, all columns updated together,
+    so the cost is O(n log n) array operations for n rows.  The routine
+    returns S, the number of values and the tie correction of each
+    column."""
+
+    n, m = X.shape
+    valid = ~np.isnan(X)
+    dense, average, ties = RankColumns(X)
+    tree = np.zeros((n + 1, m), dtype=np.int64)
+    columns = np.arange(m)
+
+    def Prefix( index ):
+        # number of values seen so far with a rank up to index
+        total = np.zeros(m, dtype=np.int64)
+        index = index.copy()
+        while index.any():
+            total += tree[index, columns]
+            index -= index & -index
+        return( total )
+
+    S = np.zeros(m, dtype=np.int64)
+    seen = np.zeros(m, dtype=np.int64)
+    for row in range(n):
+        rank = np.where(valid[row], dense[row], 0)
+        add = valid[row].astype(np.int64)
+        S += add*(Prefix(np.maximum(rank - 1, 0)) - (seen - Prefix(rank)))
+
+        # add the values of this row to the trees
+        index = rank.copy()
+        while (index > 0).any():
+            inside = (index > 0) & (index <= n)
+            tree[index[inside], columns[inside]] += 1
+            index = np.where(inside, index + (index & -index), 0)
+        seen += add
+
+    return( S, valid.sum(axis=0), ties )
+
+def PettittK( X ):
+    """This function computes the Pettitt change-point statistic of each
+    column of the 2-D array X, ignoring NaN values.  U at row t is 2 times
+    the sum of the ranks up to t minus t(n+1), so all U come from one
+    cumulative sum of the ranks.  The routine returns K, the largest |U|,
+    and the row at which it occurs (the last row before the change)."""
+
+    valid = ~np.isnan(X)
+    dense, average, ties = RankColumns(X)
+    n = valid.sum(axis=0)
+    U = 2*np.cumsum(np.where(valid, average, 0.0), axis=0) - np.cumsum(valid, axis=0)*(n + 1)
+    U = np.where(valid, np.abs(U), -1.0)
+    row = np.argmax(U, axis=0)
+    K = np.take_along_axis(U, row[None, :], axis=0)[0]
+
+    return( np.maximum(K, 0.0), row )
+
+def ColumnMedian( X ):
+    """This function returns the median of each column of the 2-D array X,
+    ignoring NaN values (NaN for a column without values), from one sort of
+    the array."""
+
+    S = np.sort(X, axis=0)
+    count = (~np.isnan(X)).sum(axis=0)
+    lo = np.take_along_axis(S, (np.maximum(count - 1, 0)//2)[None, :], axis=0)[0]
+    hi = np.take_along_axis(S, np.minimum(count//2, len(S) - 1)[None, :], axis=0)[0]
+
+    return( np.where(count > 0, (lo + hi)/2, np.nan) )
+
+def SenSlope( X, memory=64*2**20 ):
+    """This function computes Sen's slope, the median of the slopes between
+    all pairs of values, of each column of the 2-D array X, per row, with
+    the matching intercept (the median of x - slope*row).  Pairs with a NaN
+    value are left out.  The slopes of all pairs are computed together for
+    blocks of columns taking about memory bytes.  The routine returns the
+    slopes and intercepts."""
+
+    n, m = X.shape
+    i, j = np.triu_indices(n, 1)
+    distance = (j - i).astype(np.float64)[:, None]
+    slope = np.full(m, np.nan)
+    block = max(1, int(memory//(max(len(i), 1)*8*3)))
+    for first in range(0, m, block):
+        Y = X[:, first:first + block]
+        slope[first:first + block] = ColumnMedian((Y[j] - Y[i])/distance)
+    intercept = ColumnMedian(X - slope[None, :]*np.arange(n)[:, None])
+
+    return( slope, intercept )
+
+def BlockBootstrap( n, replicates, blockLength, rng ):
+    """This function returns a (replicates, n) array of row indices of
+    moving block bootstrap samples of a series of n rows, made of blocks of
+    blockLength consecutive rows starting at random rows."""
+
+    nBlocks = -(-n//blockLength)
+    starts = rng.integers(0, n - blockLength + 1, size=(replicates, nBlocks))
+    rows = (starts[:, :, None] + np.arange(blockLength)).reshape(replicates, -1)[:, :n]
+
+    return( rows )
+
+def GetTrends( DataDF, columns=None, bootstrap=0, blockLength=None, seed=0,
+               memory=64*2**20 ):
+    """This function tests every metric column of a table of annual (or
+    monthly) values, such as WYDataDF, for a monotonic trend with the
+    Mann-Kendall test and Sen's slope, and for a change in level with the
+    Pettitt test, all columns at once.  columns defaults to every numeric
+    column except site_no.  If DataDF has a "Station" column, as in the
+    combined tables of several stations, the tables of the stations are
+    aligned by date and every station and metric is tested together.
+    Missing values are left out of every statistic.
+
+    The Mann-Kendall p value is from the normal approximation with the
+    variance corrected for ties, and the Pettitt p value from its usual
+    approximation.  With bootstrap set to a number of replicates, both are
+    also estimated by comparing S and K with their values in moving block
+    bootstrap samples of each series (blocks of blockLength rows, n**(1/3)
+    rounded up by default), which keeps the serial correlation of the
+    series but removes any trend.  Sen's slope is per row, i.e. per water
+    year for WYDataDF.
+
+    The routine returns a DataFrame with one row per column (or per station
+    and column) and the columns "n", "S", "Var S", "Z", "p", "Tau",
+    "Slope", "Intercept", "Change Point" (the date of the last row before
+    the change), "K" and "Pettitt p", plus "p (bootstrap)" and
+    "Pettitt p (bootstrap)" with bootstrap."""
+
+    # one column per series, aligned in time
+    if columns is None:
+        columns = [col for col in DataDF.select_dtypes('number').columns if col not in ['site_no']]
+    if 'Station' in DataDF.columns:
+        stations = list(pd.unique(DataDF['Station']))
+        Wide = DataDF.set_index('Station', append=True)[columns].unstack('Station')
+        Wide = Wide.swaplevel(axis=1).reindex(columns=pd.MultiIndex.from_product([stations, columns]))
+        Wide.columns.names = ['Station', None]
+    else:
+        Wide = DataDF[columns]
+    X = Wide.values.astype(np.float64)
+    nRows = len(X)
+
+    # Mann-Kendall test
+    S, n, ties = KendallS(X)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        varS = (n*(n - 1)*(2*n + 5) - ties)/18
+        Z = np.where(S > 0, (S - 1)/np.sqrt(varS), np.where(S < 0, (S + 1)/np.sqrt(varS), 0.0))
+        Z[n < 3] = np.nan
+        p = 2*stats.norm.sf(np.abs(Z))
+        tau = S/(n*(n - 1)/2)
+
+        # Sen's slope and the Pettitt test
+        slope, intercept = SenSlope(X, memory)
+        K, row = PettittK(X)
+        pettitt = np.minimum(1.0, 2*np.exp(-6*K**2/(n**3 + n**2)))
+        pettitt[n < 3] = np.nan
+
+    Trends = pd.DataFrame({'n': n, 'S': S, 'Var S': varS, 'Z': Z, 'p': p, 'Tau': tau,
+                           'Slope': slope, 'Intercept': intercept,
+                           'Change Point': Wide.index[row].where(n >= 3),
+                           'K': K, 'Pettitt p': pettitt}, index=Wide.columns)
+
+    # significance from block bootstrap samples, a number of replicates at
+    # a time that fits in memory
+    if bootstrap > 0:
+        if blockLength is None:
+            blockLength = int(np.ceil(nRows**(1/3)))
+        blockLength = max(1, min(blockLength, nRows))
+        rng = np.random.default_rng(seed)
+        exceedS = np.zeros(X.shape[1])
+        exceedK = np.zeros(X.shape[1])
+        chunk = max(1, int(memory//(X.size*8*6)))
+        for first in range(0, bootstrap, chunk):
+            replicates = min(chunk, bootstrap - first)
+            rows = BlockBootstrap(nRows, replicates, blockLength, rng)
+            Xb = X[rows.T].reshape(nRows, -1)
+            Sb = KendallS(Xb)[0].reshape(replicates, -1)
+            Kb = PettittK(Xb)[0].reshape(replicates, -1)
+            exceedS += (np.abs(Sb) >= np.abs(S)).sum(axis=0)
+            exceedK += (Kb >= K).sum(axis=0)
+        Trends['p (bootstrap)'] = np.where(n >= 3, (exceedS + 1)/(bootstrap + 1), np.nan)
+        Trends['Pettitt p (bootstrap)'] = np.where(n >= 3, (exceedK + 1)/(bootstrap + 1), np.nan)
+
+    return( Trends )